@@ -1,386 +1,228 @@
-from flask import Flask, jsonify, request
-import datetime as d
-from datetime import datetime
-from psycopg_pool import ConnectionPool
-import os
-import tzlocal
-from zoneinfo import ZoneInfo
-from dotenv import load_dotenv
-load_dotenv()
+from flask import Flask, Response, jsonify, request, stream_with_context
+from psycopg_pool import ConnectionPool, PoolTimeout
+import contextlib
+import threading
+from result_cache import ResultCache
+from query_compiler import SHAPES, QueryCompiler, RequestError, execute
+from stats_config import require_conninfo, stats_config
+from stats_encoding import JSON, build_rows, encode, encode_json, response_format, row_encoder
+from stats_format import build_result, cache_end, cache_key, dumps, format_row, wants_ndjson
+from stats_metrics import Metrics, PhaseTimer, SlowQueryLog
 
-app = Flask(__name__)
+#app factory: nothing is read or connected at import; "config" defaults to stats_config() (the environment)
+#and a pool can be passed in instead of connecting to DB_*; a pool passed in is opened and closed by its owner,
+#a pool created here is opened on the first request (or right away with STATS_WARMUP=true);
+#app.close() stops the result cache listener and closes the pool created here
+#run with: flask --app STATS run, gunicorn "STATS:create_app()" (or python STATS.py)
+def create_app(config=None, pool=None):
+    config = config if config is not None else stats_config()
+    app = Flask(__name__)
 
-#----------------------------------------------DB CONNECTION-----------------------------------------------------------
-#using cloud hosted PostgreSQL database
-host = os.environ['DB_HOST']
-db_name = os.environ['DB_NAME']
-user = os.environ['DB_USER']
-password = os.environ['DB_PASSWORD']
-port = os.environ['DB_PORT']
+    #----------------------------------------------DB CONNECTION-------------------------------------------------------
+    backend = config["backend"]
+    snapshot = None
+    own_pool = False
+    if backend=="duckdb":
+        from stats_duckdb import SnapshotBackend
+        snapshot = SnapshotBackend(config["snapshot_dir"])
+    elif pool is None:
+        pool = ConnectionPool(conninfo=require_conninfo(config), min_size=1, max_size=5, timeout=30, open=False)
+        own_pool = True
 
-conninfo = f"host={host} port={port} dbname={db_name} user={user} password={password} sslmode='require'" 
-pool = ConnectionPool(conninfo=conninfo, min_size=1, max_size=5, timeout=30)
+    compiler = QueryCompiler(config["timezone"])
+    stream_chunk = config["stream_chunk"]
 
-#use time zone from the environment if set; otherwise default to system time zone
-if 'IANA_TIMEZONE' in os.environ:
-    current_timezone = os.environ['IANA_TIMEZONE']
-else:
-    current_timezone = tzlocal.get_localzone_name()
+    #----------------------------------------------RESULT CACHE--------------------------------------------------------
+    #responses are cached until "history" changes (see result_cache.py), only while notifications are received
+    result_cache = ResultCache(config["cache_size"])
 
-#format ms to largest possible time unit
-def format_time(ms):
-    if ms is None:
-        return "0 s"
-    seconds = int(ms // 1000)
-    time = d.timedelta(seconds=seconds)
-    days = time.days
-    hours, remainder = divmod(time.seconds, 3600)
-    minutes, seconds = divmod(remainder, 60)
-    result = ""
-    hours += days*24
-    if hours:
-        result = str(hours) + "h " + str(minutes) + "m " + str(seconds) + "s"
-    elif minutes:
-        result = str(minutes)+ "m " + str(seconds) + "s"
-    elif seconds:
-        result = str(seconds) + "s"
-    else:
-        result = "0 s"
-    
-    return result
+    #----------------------------------------------INSTRUMENTATION-----------------------------------------------------
+    #phase durations per endpoint and query shape (/metrics), and plans of queries slower than STATS_SLOW_QUERY_MS (/debug/slow-queries)
+    metrics = Metrics()
+    slow_queries = SlowQueryLog(config["slow_query_ms"] if config["debug_routes"] else None, config["slow_query_log"])
 
-def format_result(results):
-    for record in results: #if records contain artists, rewrite them as a list
-        if record.get('artist1'): 
-            artists = [record['artist1']]
-            record.pop('artist1')
-            for i in range (2,4):
-                if record[f"artist{i}"] is not None:
-                    artists.append(record[f"artist{i}"])
-                record.pop(f"artist{i}")
-            record['artists'] = ", ".join(artists)
-            artists.clear()
-        else:
-            break
-    return results
+    opening = threading.Lock()
+    opened = threading.Event()
 
-def format_date(date, date_type='start'):
-    if date is None:
-        return None
-    if isinstance(date, str):
-        #convert date to ISO format
-        date = date.replace(" ", "-").replace("/", "-")
-        date = datetime.fromisoformat(date)
-    
-    #format end date to make date interval inclusive
-    if date_type=='end' and date.hour==0 and date.minute==0:
-        date = date.replace(hour=23, minute=59, second=59, microsecond=999999)
-    #add timezone
-    datetz = date.replace(tzinfo=ZoneInfo(current_timezone))
-    return datetz
+    #a pool connection; the first request opens the pool (if created here) and starts the result cache listener
+    def connection():
+        if not opened.is_set():
+            with opening:
+                if not opened.is_set():
+                    if own_pool:
+                        pool.open(wait=config["warmup"])
+                    if result_cache.max_entries>0 and config["conninfo"]:
+                        result_cache.start(config["conninfo"])
+                    opened.set()
+        return pool.connection()
 
-def compare_dates(start, end):
-    if start is None or end is None:
-        return True
-    if end>start:
-        return True
-    return False
+    def close():
+        result_cache.stop()
+        if own_pool:
+            pool.close()
 
-@app.route('/statistics/streams', methods=['GET'])
-def get_stats_by_streams():
-    artists = request.args.getlist('artist') 
-    name = request.args.get('track') 
-    start = request.args.get('startDate') 
-    end = request.args.get('endDate') 
-    limit = request.args.get('limit', 20)
-    analysis_type = request.args.get('type')
-    
-    if len(request.args)<1: #a minimum of one parameter is required
-        return jsonify({"error":"No parameters were selected."}), 400
-    elif len(request.args)==1 and 'limit' in request.args: #"limit" cannot be the only one parameter
-        return jsonify({"error":"Select additional parameters."}), 400
-    
-    #parameter checking
-    if name and not artists: #name requires artist, as song names are not unique
-        return jsonify({"error":"Missing data: enter at least one artist."}), 400
-    
-    if len(artists)>3: #up to 3 artists per track are logged
-        return jsonify({"error": "Too many artists entered. The maximum allowed is 3."}), 400
-    
-    if len(artists)>1 and not name: #when more than 1 artist is provided, statistics are for a specific track
-        return jsonify({"error":"Missing data: enter a track name."}), 400
-    
-    if artists and analysis_type: #type ignored when artists are provided
-        analysis_type = None
-    
-    if analysis_type and analysis_type not in ['tracks', 'artists']: #general statistics can be either by tracks or artists 
-        return jsonify({"error":"Invalid type selected. Allowed types: 'artists', 'tracks'."}), 400
-    
-    if (start or end) and (not analysis_type and not artists): #interval cannot be the only parameter
-        return jsonify({"error":"Select additional parameters."}), 400
-    
-    
-    start = format_date(start)
-    end = format_date(end, 'end')
-    if not compare_dates(start, end):
-        return jsonify({"error":"The end date cannot be earlier than the start date."}), 400
-    
-    #---------------------------------------------QUERY FORMATION
-    #query parts included in every query
-    from_part = " FROM history "
-    ending = " ORDER BY streams DESC\nLIMIT %s"
-    #query parts that will be formed dynamically based on parameters 
-    select_part = ["SELECT COUNT(*) as streams"]
-    where_part = ["WHERE progress>=45000 "]
-    group_part = []
-    params = []
-    
-    #artist, name and type parameters handling
-    if artists and name:
-        num = len(artists)
-        temp = []
-        for i in range (1,4):
-            field = f"artist{i}"
-            select_part.append(field)
-            group_part.append(field)
-            variables = ",".join(["%s"]*num)
-            temp.append(f"{field} IN ({variables})")
-            params.extend(artists)
-        temp = " OR ".join(temp)
-        where_part.append("("+temp+")")
-        select_part.append("track_name")
-        where_part.append("track_name LIKE %s")
-        group_part.append("track_name")  
-        params.append(name + '%')
-    elif artists and not name:
-        select_part.append("track_name ")
-        where_part.append("(artist1 = %s OR artist2 = %s OR artist3 = %s)")
-        group_part.append("track_name ")
-        params.extend([artists[0]]*3)
-    elif not artists and not name and analysis_type:
-        if analysis_type=="artists": #general statistics - top artists
-            select_part.append("artist")
-            group_part.append("artist")
-            from_part = """
-            FROM (
-                SELECT played_at, artist1 as artist, track_name, progress FROM history
-                UNION ALL
-                SELECT played_at, artist2 as artist, track_name, progress FROM history WHERE artist2 IS NOT NULL
-                UNION ALL
-                SELECT played_at, artist3 as artist, track_name, progress FROM history WHERE artist3 IS NOT NULL
-            ) as temp
-            """
-        elif analysis_type=="tracks": #general statistics - top tracks
-            select_part.append("CONCAT_WS(', ', artist1, artist2, artist3) as artists, track_name ")
-            group_part.append("artist1, artist2, artist3, track_name ")
-    
-    #start and end parameter handling   
-    if start:
-        where_part.append("played_at >= %s")
-        params.append(start)
-    if end:
-        where_part.append("played_at <= %s")
-        params.append(end)
-    
-    #limit parameter handling
-    params.append(limit)
-        
-    query = ", ".join(select_part) + from_part + " AND ".join(where_part) + " GROUP BY " + ", ".join(group_part) + ending
-   
-    with pool.connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(query, params)
-            rows = cursor.fetchall()
-            columns = [desc[0] for desc in cursor.description]
-            result = [dict(zip(columns, row)) for row in rows]
-            result = format_result(result)
-    if result:
-        return jsonify(result), 200
-    else:
-         return jsonify({"message":"No data found for the selected parameters."}), 200
-    
-@app.route('/statistics/duration', methods=['GET'])
-def get_stats_by_duration():
-    artists = request.args.getlist('artist') 
-    name = request.args.get('track') 
-    start = request.args.get('startDate') 
-    end = request.args.get('endDate') 
-    limit = request.args.get('limit', 20)
-    analysis_type = request.args.get('type')
-    
-    if len(request.args)<1:  #a minimum of one parameter is required
-        return jsonify({"error":"No parameters were selected."}), 400
-    elif len(request.args)==1 and 'limit' in request.args: #"limit" cannot be the only one parameter
-        return jsonify({"error":"Select additional parameters."}), 400
-    
-    #parameter checking
-    if name and not artists: #name requires artist, as song names are not unique
-        return jsonify({"error":"Missing data: enter at least one artist."}), 400
-    
-    if len(artists)>3: #up to 3 artists per track are logged
-        return jsonify({"error": "Too many artists entered. The maximum allowed is 3."}), 400
-    
-    if len(artists)>1 and not name: #when more than 1 artist is provided, statistics are for a specific track
-        return jsonify({"error":"Missing data: enter a track name."}), 400
-    
-    if artists and analysis_type: #type ignored when artists are provided
-        analysis_type = None
-        
-    if analysis_type and analysis_type not in ['tracks', 'artists']: #general statistics can be either by tracks or artists 
-        return jsonify({"error":"Invalid type selected. Allowed types: 'artists', 'tracks'."}), 400
-    
-    if (start or end) and (not analysis_type and not artists): #interval cannot be the only parameter
-        return jsonify({"error":"Select additional parameters."}), 400
-    
-    
-    start = format_date(start)
-    end = format_date(end, 'end')
-    if not compare_dates(start, end):
-        return jsonify({"error":"The end date cannot be earlier than the start date."}), 400
-    
-    #---------------------------------------------QUERY FORMATION
-    #query parts included in every query
-    from_part = "FROM history "
-    ending = "\nORDER BY ms DESC\nLIMIT %s"
-    #query parts that will be formed dynamically based on parameters
-    select_part = []
-    where_part = []
-    where_temp = []
-    group_part = []
-    params = []
-    
-    #artist, name and type parameters handling
-    if artists and name:
-        num = len(artists)
-        temp = []
-        for i in range (1,4): 
-            field = f"artist{i}"
-            select_part.append(field)
-            group_part.append(field)
-            variables = ",".join(["%s"]*num)
-            temp.append(f"{field} IN ({variables})")
-            params.extend(artists)
-        temp = " OR ".join(temp)
-        where_temp.append("("+temp+")")
-        select_part.append("track_name")
-        where_temp.append("track_name LIKE %s")
-        group_part.append("track_name")  
-        params.append(name + '%')
-    elif artists and not name:
-        select_part.append("track_name ")
-        where_temp.append("(artist1 = %s OR artist2 = %s OR artist3 = %s)")
-        group_part.append("track_name ")
-        params.extend([artists[0]]*3)
-    elif not artists and not name and analysis_type:
-        if analysis_type=="artists": #general statistics - top artists
-            select_part.append("artist")
-            group_part.append("artist")
-            from_part = """
-            FROM (
-                SELECT played_at, artist1 as artist, track_name, progress FROM history
-                UNION ALL
-                SELECT played_at, artist2 as artist, track_name, progress FROM history WHERE artist2 IS NOT NULL
-                UNION ALL
-                SELECT played_at, artist3 as artist, track_name, progress FROM history WHERE artist3 IS NOT NULL
-            ) as temp
-            """
-        elif analysis_type=="tracks": #general statistics - top tracks
-            select_part.append("CONCAT_WS(', ', artist1, artist2, artist3) as artists, track_name ")
-            group_part.append("artist1, artist2, artist3, track_name ")
-    
-    #start and end parameter handling   
-    if start:
-        where_temp.append("played_at >= %s")
-        params.append(start)
-    if end:
-        where_temp.append("played_at <= %s")
-        params.append(end)
-    
-    #limit parameter handling
-    params.append(limit)
-    
-    if len(where_temp)>0:
-        where_part = "WHERE " + " AND ".join(where_temp)
-    else:
-        where_part = ""
-    select_part.append("sum(progress) as ms ")
-    
-    query = "SELECT " + ", ".join(select_part) + from_part + where_part + " GROUP BY " + ", ".join(group_part) + ending
+    app.close = close
 
-    with pool.connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(query, params)
-            rows = cursor.fetchall()
-            columns = [desc[0] for desc in cursor.description]
-            result = [dict(zip(columns, row)) for row in rows]
-            result = format_result(result)
-    for row in result:
-        row['totalDuration'] = format_time(row['ms'])
-        row.pop('ms')
-      
-    if result:
-        return jsonify(result), 200
-    else:
-        return jsonify({"message":"No data found for the selected parameters."}), 200
-   
-@app.route('/statistics/total', methods=['GET'])
-def get_streaming_time():
-    start = request.args.get('startDate')
-    end = request.args.get('endDate')
-    artists = request.args.getlist('artist')
+    if pool is not None and config["warmup"]:
+        connection()
 
-    if len(artists)>1:
-        return jsonify({"error":"Too many artists entered. Only one artist is allowed."}), 400
-    
-    
-    start = format_date(start)
-    end = format_date(end, 'end')
-    if not compare_dates(start, end):
-        return jsonify({"error":"The end date cannot be earlier than the start date."}), 400
-        
-    params = []
-    where_temp = []
-    query_start = "SELECT SUM(progress) as ms \nFROM history "
-     
-    if start:
-        where_temp.append("played_at >= %s")
-        params.append(start)
-    if end:
-        where_temp.append("played_at <= %s")
-        params.append(end)
-        
-    if artists:
-        artist = artists[0]
-        temp = []
-        for i in range (1,4):
-            temp.append(f"artist{i} like %s")
-        temp = " OR ".join(temp)
-        where_temp.append("("+temp+")")
-        params.extend([artist]*3)
-    
-    if len(where_temp)>0:
-        where_part = " WHERE " + " AND ".join(where_temp)
-    else:
-        where_part = ""
-           
-    query = query_start + where_part
-    
-    with pool.connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(query, params)
-            rows = cursor.fetchall()
-            columns = [desc[0] for desc in cursor.description]
-            result = [dict(zip(columns, row)) for row in rows]
-    for row in result:
-        if artists:
-            row['artist']=artists[0]
-        row['total streaming time'] = format_time(row['ms'])
-        row.pop('ms')
-    if result:
-        return jsonify(result), 200
-    else:
-        return jsonify({"message":"No data found for the selected parameters."}), 200
+    #parse and validate the request, then answer it from the result cache or run its query shape;
+    #the shape is reported in the "X-Query-Shape" header, the token of the next page (if any) in "X-Next-Page"
+    def respond(endpoint):
+        timer = PhaseTimer()
+        try:
+            req = compiler.parse(endpoint, request.args)
+            shape, params = compiler.bind(endpoint, req)
+        except RequestError as e:
+            return jsonify({"error":str(e)}), 400
+        timer.lap("parse")
+        if backend=="duckdb" and (endpoint not in snapshot.endpoints or req["approx"]):
+            return jsonify({"error":"Not available with the snapshot backend."}), 501
+        #every request with a query shape is recorded with its status, including the phase it failed in
+        status = 500
+        try:
+            if endpoint in ['streams', 'duration'] and not req["approx"] and wants_ndjson(request.args, request.headers.get('Accept', '')):
+                if backend=="duckdb":
+                    response = Response(stream_with_context(stream_snapshot(endpoint, req, shape)), mimetype='application/x-ndjson')
+                else:
+                    stack, cursor = open_stream(shape, params, timer)
+                    response = Response(stream_with_context(stream_rows(endpoint, req, stack, cursor)), mimetype='application/x-ndjson')
+                    #the stack is also closed with the response, in case the stream was never started
+                    response.call_on_close(stack.close)
+                response.headers['X-Query-Shape'] = shape
+                status = 200
+                return response, 200
+
+            key = cache_key(shape, params)
+            generation = result_cache.generation
+            cached = result_cache.get(key)
+            timer.lap("cache")
+            if cached is None:
+                cached = run_query(endpoint, req, shape, params, timer)
+                result_cache.put(key, cached, cache_end(endpoint, req), generation)
+            result, next_page = cached
+            mimetype = response_format(request.headers.get('Accept', ''))
+            if mimetype==JSON and app.debug: #pretty-printed by Flask in debug mode
+                response = jsonify(result)
+            else:
+                data, mimetype = encode(result, mimetype)
+                response = Response(data, mimetype=mimetype)
+            timer.lap("serialize")
+            response.headers['X-Query-Shape'] = shape
+            response.headers['Server-Timing'] = timer.server_timing()
+            if next_page:
+                response.headers['X-Next-Page'] = next_page
+            status = 200
+            return response, 200
+        except PoolTimeout:
+            timer.lap("pool")
+            raise
+        except Exception:
+            timer.lap("error")
+            raise
+        finally:
+            metrics.observe(endpoint, shape, timer, status)
+
+    #rows of the query shape formatted for the response, and the token of the next page if the page is full
+    def run_query(endpoint, req, shape, params, timer):
+        if backend=="duckdb":
+            rows = list(snapshot.rows(endpoint, req, shape))
+            timer.lap("execute")
+            result = build_result(endpoint, req, shape, params, rows)
+            timer.lap("format")
+            return result
+        with connection() as conn:
+            started = timer.lap("pool")
+            with conn.cursor() as cursor:
+                execute(cursor, shape, params)
+                executed = timer.lap("execute")
+                rows = cursor.fetchall()
+                columns = [desc[0] for desc in cursor.description]
+                timer.lap("fetch")
+        if slow_queries.begin(shape, executed-started):
+            threading.Thread(target=explain_query, args=(endpoint, shape, params, executed-started), daemon=True).start()
+        result = build_rows(endpoint, req, shape, params, columns, rows)
+        timer.lap("format")
+        return result
+
+    #plan of a slow query (run again with EXPLAIN ANALYZE) for /debug/slow-queries
+    def explain_query(endpoint, shape, params, seconds):
+        try:
+            with connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(slow_queries.explain + SHAPES[shape], params)
+                    plan = "\n".join(row[0] for row in cursor.fetchall())
+        except Exception as e:
+            plan = f"Plan couldn't be captured: {e}"
+        slow_queries.record(endpoint, shape, seconds, SHAPES[shape], params, plan)
+
+    #all rows of the query shape (from the page token on, up to the limit) as NDJSON,
+    #read from a server-side cursor in chunks, so memory use doesn't depend on the number of rows;
+    #the connection is taken and the query started before the response is sent (as in stats_asgi.py),
+    #"stack" releases the connection when the stream ends
+    def open_stream(shape, params, timer):
+        stack = contextlib.ExitStack()
+        try:
+            conn = stack.enter_context(connection())
+            timer.lap("pool")
+            cursor = stack.enter_context(conn.cursor(name="stats_stream"))
+            cursor.execute(SHAPES[shape], params)
+            timer.lap("execute")
+        except BaseException:
+            stack.close()
+            raise
+        return stack, cursor
+
+    def stream_rows(endpoint, req, stack, cursor):
+        with stack:
+            encode_row = row_encoder(endpoint, req, [desc[0] for desc in cursor.description])
+            while True:
+                rows = cursor.fetchmany(stream_chunk)
+                if not rows:
+                    break
+                for row in rows:
+                    yield encode_json(encode_row(row))
+
+    def stream_snapshot(endpoint, req, shape):
+        for row in snapshot.rows(endpoint, req, shape, stream_chunk):
+            yield dumps(format_row(endpoint, req, row))
+
+    @app.route('/statistics/streams', methods=['GET'])
+    def get_stats_by_streams():
+        return respond('streams')
+
+    @app.route('/statistics/duration', methods=['GET'])
+    def get_stats_by_duration():
+        return respond('duration')
+
+    @app.route('/statistics/summary', methods=['GET'])
+    def get_summary():
+        return respond('summary')
+
+    @app.route('/statistics/timeline', methods=['GET'])
+    def get_timeline():
+        return respond('timeline')
+
+    @app.route('/statistics/sessions', methods=['GET'])
+    def get_sessions():
+        return respond('sessions')
+
+    @app.route('/statistics/total', methods=['GET'])
+    def get_streaming_time():
+        return respond('total')
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    #SQL and parameters of slow queries are only served with STATS_DEBUG_ROUTES=true
+    if config["debug_routes"]:
+        @app.route('/debug/slow-queries', methods=['GET'])
+        def get_slow_queries():
+            return jsonify(slow_queries.list())
+
+    return app
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -1,193 +1,357 @@
-import spotipy
 from spotipy.oauth2 import SpotifyOAuth
+from spotipy.cache_handler import CacheFileHandler
 import asyncio
 from spotipy.exceptions import SpotifyException
-import datetime as d
-from datetime import datetime
-from psycopg_pool import ConnectionPool
+from psycopg_pool import AsyncConnectionPool
+import httpx
 import json
 import os
 import tzlocal
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
-load_dotenv()
+from history_cache import HistoryCache
+from spool import Spool
+from error_sink import ErrorSink
+from spotify_async import AsyncSpotify
+from rate_limit import RateLimiter
+from scheduler import PollScheduler
+from queue_rules import QueueRules, QueueSnapshot
+from sketches import SKETCH_SOURCES, UPSERT, build_sketches, source_params
 
 scope = "user-read-recently-played user-read-playback-state user-modify-playback-state"
 
-#----------------------------------------------LOGIN-SPOTIFY-----------------------------------------------------------
-client_id = os.environ['SP_CLIENT_ID']
-client_secret = os.environ['SP_CLIENT_SECRET']
-redirect_uri = os.environ['SP_REDIRECT_URI']
-    
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-    client_id=client_id,
-    client_secret=client_secret,
-    redirect_uri=redirect_uri, 
-    scope=scope))
-
-#----------------------------------------------DB CONNECTION-----------------------------------------------------------
-#using cloud hosted PostgreSQL database
-host = os.environ['DB_HOST']
-db_name = os.environ['DB_NAME']
-user = os.environ['DB_USER']
-password = os.environ['DB_PASSWORD']
-port = os.environ['DB_PORT']
-
-conninfo = f"host={host} port={port} dbname={db_name} user={user} password={password} sslmode='require'" 
-pool = ConnectionPool(conninfo=conninfo, min_size=1, max_size=5, timeout=30)
-
-#custom queueing
-with open('queue.json', 'r') as file:
-    queue_combos = json.load(file)
-last_song = ""
-added = False
-queue_config = bool(len(queue_combos)>0)
-
-#use time zone from the environment if set; otherwise default to system time zone
-if 'IANA_TIMEZONE' in os.environ:
-    current_timezone = os.environ['IANA_TIMEZONE']
-else:
-    current_timezone = tzlocal.get_localzone_name()
-
-#log errors to database table "error_log"
-def log_error(error, code):
-    time = datetime.now(ZoneInfo(current_timezone))
-    query = f"INSERT INTO error_log (date, type, description) VALUES (%s, %s, %s) RETURNING id;"
-    with pool.connection() as conn:
-        with conn.cursor() as cursor:
-            try: 
-                cursor.execute(query, (time, code, error))
-                id = cursor.fetchone()[0]
-                msg = f"Error logged. ID: {id}"
-                print(msg)
-            except Exception as e:
-                exep = str(e)
-                print(f"{time} Exception couldn't be written to database: {exep}\n")
-    
-def compare_dates (old_date, duration):
-    difference = datetime.now(ZoneInfo(current_timezone)) - old_date
-    difference = difference.total_seconds() * 1000
-    
-    return difference<duration
-
-def insert_record(data):
-    required = ['artists', 'name', 'progress', 'duration']
-    for field in required:
-        if field not in data or field==" ":
-            log_error("400", "Insert record, missing data: {field}.")
-            return
-    
-    #new record
-    artists = data['artists']
-    name = data['name']
-    duration = data['duration']
-    progress = data['progress']
-    
-    #log up to 3 artists per track
-    artist1, artist2, artist3 = (artists+[None]*3)[:3]
-    if artist1==None:
-        artist1 = "No artist"
-    
-    #get last record
-    query = f"SELECT * FROM history ORDER BY played_at DESC LIMIT 1;"
-    with pool.connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(query)
-            rows = cursor.fetchall()
-            if rows:
-                columns = [desc[0] for desc in cursor.description]
-                result = [dict(zip(columns, row)) for row in rows]
-                
-                #data from last record
-                id = result[0]['id']
-                old_duration = result[0]['duration']
-                old_progress = result[0]['progress']
-                old_date = result[0]['played_at']
-                if result[0]['artist1']==artist1 and result[0]['track_name']==name: #the same song playing
-                    if old_progress<=progress and compare_dates(old_date, old_duration):
-                        query = f"UPDATE history SET progress = %s WHERE id = %s"
-                        cursor.execute(query, (progress, id))
-                    else: #song was replayed
-                        played_at = datetime.now(ZoneInfo(current_timezone)) 
-                        if old_duration-old_progress<6000 and compare_dates(old_date, old_duration): #song was replayed with less than 6s remaining (may happen due to 5s logging interval)
-                            query = f"UPDATE history SET progress = %s WHERE id = %s;"
-                            cursor.execute(query, (old_duration, id))
-                        query = f"\nINSERT INTO history (artist1, artist2, artist3, played_at, track_name, progress, duration)\nVALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id;"
-                        cursor.execute(query, (artist1, artist2, artist3, played_at, name, progress, duration))
-                        id = cursor.fetchone()[0]
-                else:
-                    if old_duration - old_progress < 6000: #previous song had less than 6s remaining (may happen due to 5s logging interval)
-                        query = f"UPDATE history SET progress = %s WHERE id = %s;"
-                        cursor.execute(query, (old_duration, id))
-                    #new song playing, inserting new record
-                    played_at = datetime.now(ZoneInfo(current_timezone))
-                    query = f"INSERT INTO history (artist1, artist2, artist3, played_at, track_name, progress, duration)\nVALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id;"
-                    cursor.execute(query, (artist1, artist2, artist3, played_at, name, progress, duration))
-                    id = cursor.fetchone()[0]
-    print(f"Updated/inserted. ID: {id}\n")
-    
-async def get_data():
-    while True:
-        global last_song, added
+#settings of the worker, read from the environment when a Worker is created (not at import)
+def worker_config(environ=None):
+    if environ is None:
+        load_dotenv()
+        environ = os.environ
+    #----------------------------------------------LOGIN-SPOTIFY-------------------------------------------------------
+    #accounts to log, every account has its own token cache (".cache-<account>")
+    #without an accounts file a single account "default" is logged using spotipy's default cache (".cache")
+    accounts_file = environ.get('ACCOUNTS_FILE', 'accounts.json')
+    if os.path.exists(accounts_file):
+        with open(accounts_file, 'r') as file:
+            accounts = json.load(file)
+    else:
+        accounts = ["default"]
+
+    #----------------------------------------------DB CONNECTION-------------------------------------------------------
+    #using cloud hosted PostgreSQL database
+    conninfo = None
+    if 'DB_HOST' in environ:
+        conninfo = f"host={environ['DB_HOST']} port={environ['DB_PORT']} dbname={environ['DB_NAME']} user={environ['DB_USER']} password={environ['DB_PASSWORD']} sslmode='require'"
+
+    #use time zone from the environment if set; otherwise default to system time zone
+    if 'IANA_TIMEZONE' in environ:
+        timezone = environ['IANA_TIMEZONE']
+    else:
+        timezone = tzlocal.get_localzone_name()
+
+    return {
+        "client_id": environ.get('SP_CLIENT_ID'),
+        "client_secret": environ.get('SP_CLIENT_SECRET'),
+        "redirect_uri": environ.get('SP_REDIRECT_URI'),
+        "accounts": accounts,
+        "conninfo": conninfo,
+        "timezone": timezone,
+        #total request rate to Spotify Web API (requests per second), shared by all accounts
+        "max_rps": float(environ.get('SP_MAX_RPS', 10)),
+        #plays are written to a local spool first and copied to the database every DB_FLUSH_INTERVAL seconds,
+        #when the track changes and when playback stops, so logging continues while the database is not available
+        "flush_interval": int(environ.get('DB_FLUSH_INTERVAL', 30)),
+        "spool_path": environ.get('SPOOL_PATH', 'spool.db'),
+        #custom queueing, changes to queue.json are picked up without a restart
+        "queue_file": 'queue.json',
+        #polling intervals (in seconds): sparse interval while playing and the longest interval while paused/inactive
+        "poll_sparse": float(environ.get('POLL_SPARSE', 30)),
+        "poll_max_idle": float(environ.get('POLL_MAX_IDLE', 60)),
+        #polls per hour of every account are written to this file in Prometheus text format
+        "metrics_file": environ.get('WORKER_METRICS_FILE'),
+        #a pause longer than SESSION_GAP seconds ends a listening session
+        "session_gap": float(environ.get('SESSION_GAP', 1800)),
+        #items kept in the daily top-K sketches (see sketches.py)
+        "sketch_capacity": int(environ.get('SKETCH_CAPACITY', 200)),
+        #repeats of the same error within ERROR_WINDOW seconds are logged as one record
+        "error_window": int(environ.get('ERROR_WINDOW', 60)),
+        #open the database pool and wait for its first connection before polling starts
+        "warmup": environ.get('WORKER_WARMUP', 'false')=="true"
+    }
+
+#polling state of one account
+class Listener:
+    def __init__(self, worker, account):
+        self.account = account
+        self.sp = worker.spotify_client(account)
+        self.history_cache = HistoryCache(worker.pool, worker.spool, worker.timezone, account, worker.config["session_gap"])
+        self.scheduler = PollScheduler(sparse=worker.config["poll_sparse"], max_idle=worker.config["poll_max_idle"])
+        self.queue_snapshot = QueueSnapshot()
+        self.last_song = ""
+
+#the poller: one Listener per account, the spool drainer, the error sink and the metrics report
+#nothing is connected when a Worker is created, the database pool is opened by run();
+#the pool, the spool and the Spotify clients ("spotify_factory(account)") can be passed in instead,
+#a pool or spool passed in is opened and closed by its owner
+class Worker:
+    def __init__(self, config=None, pool=None, spool=None, spotify_factory=None):
+        self.config = config if config is not None else worker_config()
+        self.timezone = self.config["timezone"]
+        self.own_pool = pool is None
+        self.own_spool = spool is None
+        if pool is None:
+            if self.config["conninfo"] is None:
+                raise RuntimeError("Database is not configured: set DB_HOST, DB_NAME, DB_USER, DB_PASSWORD and DB_PORT.")
+            #shared by all accounts; an async pool is opened in run(), it needs a running event loop
+            pool = AsyncConnectionPool(conninfo=self.config["conninfo"], min_size=1, max_size=5, timeout=30, open=False)
+        self.pool = pool
+        self.spool = spool if spool is not None else Spool(self.config["spool_path"])
+        self.spotify_factory = spotify_factory
+        self.limiter = RateLimiter(self.config["max_rps"])
+        #one http client (and its connections) for all accounts, created with the first Spotify client
+        self.http_client = None
+        self.queue_rules = QueueRules(self.config["queue_file"])
+        self.error_sink = ErrorSink(self.pool, self.timezone, self.config["error_window"])
+        self.flush_interval = self.config["flush_interval"]
+        #wakes up the spool drainer before DB_FLUSH_INTERVAL passes
+        self.drain_event = asyncio.Event()
+        #references to running queue handling tasks (asyncio only keeps weak references)
+        self.background_tasks = set()
+        self.listeners = [Listener(self, account) for account in self.config["accounts"]]
+
+    def spotify_client(self, account):
+        if self.spotify_factory is not None:
+            return self.spotify_factory(account)
+        if self.http_client is None:
+            self.http_client = httpx.AsyncClient(timeout=10)
+        cache_path = ".cache" if account=="default" else f".cache-{account}"
+        #the worker runs on a single event loop, so Spotify requests must not block it
+        return AsyncSpotify(auth_manager=SpotifyOAuth(
+            client_id=self.config["client_id"],
+            client_secret=self.config["client_secret"],
+            redirect_uri=self.config["redirect_uri"],
+            scope=scope,
+            cache_handler=CacheFileHandler(cache_path=cache_path)),
+            client=self.http_client,
+            limiter=self.limiter)
+
+    #log errors to database table "error_log"
+    #errors are collected in memory and written in batches by error_sink.run(), so logging never blocks polling
+    def log_error(self, error, code, account="default"):
+        if account!="default":
+            error = f"[{account}] {error}"
+        self.error_sink.add(code, error)
+
+    async def insert_record(self, listener, data):
+        required = ['artists', 'name', 'progress', 'duration']
+        for field in required:
+            if field not in data or field==" ":
+                self.log_error("400", "Insert record, missing data: {field}.", listener.account)
+                return
+
+        #new record
+        artists = data['artists']
+        name = data['name']
+        duration = data['duration']
+        progress = data['progress']
+
+        last_id = listener.history_cache.last['play_id'] if listener.history_cache.last else None
+        id = await listener.history_cache.record(artists, name, progress, duration)
+        if id!=last_id: #track changed
+            self.drain_event.set()
+        print(f"{listener.account}: Updated/inserted. ID: {id}\n")
+
+    #copy pending plays from the spool to "history" in batches
+    #plays are upserted by play_id, so a batch that is copied twice does not create duplicates
+    async def drain_spool(self, batch_size=500):
+        spool = self.spool
+        delay = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self.drain_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.drain_event.clear()
+            try:
+                while True:
+                    pending = spool.pending(batch_size)
+                    sessions = spool.pending_sessions(batch_size)
+                    if not pending and not sessions:
+                        break
+                    values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s)"]*len(pending))
+                    params = [play[column] for play, version in pending for column in Spool.columns]
+                    #all artists of new plays go to "history_artists"
+                    play_ids = []
+                    names = []
+                    positions = []
+                    for play, version in pending:
+                        for position, name in enumerate(play['artists'], 1):
+                            play_ids.append(play['play_id'])
+                            names.append(name)
+                            positions.append(position)
+                    query = f"""
+                        WITH upserted AS (
+                            INSERT INTO history (play_id, account, artist1, artist2, artist3, track_name, played_at, progress, duration)
+                            VALUES {values}
+                            ON CONFLICT (play_id) DO UPDATE SET progress = EXCLUDED.progress
+                            RETURNING id, play_id, (xmax = 0) as inserted
+                        )
+                        INSERT INTO history_artists (history_id, artist_id, position)
+                        SELECT u.id, a.id, v.position
+                        FROM upserted u
+                        JOIN unnest(%s::uuid[], %s::text[], %s::int2[]) as v(play_id, name, position) ON v.play_id = u.play_id
+                        JOIN artists a ON a.name = v.name
+                        WHERE u.inserted
+                        ON CONFLICT DO NOTHING;
+                    """
+                    #sessions are copied in the same transaction as their plays
+                    session_values = ", ".join(["(%s, %s, %s, %s, %s, %s)"]*len(sessions))
+                    session_params = [session[column] for session, version in sessions for column in Spool.session_columns]
+                    session_query = f"""
+                        INSERT INTO sessions (session_id, account, started_at, ended_at, tracks, ms)
+                        VALUES {session_values}
+                        ON CONFLICT (session_id) DO UPDATE SET ended_at = EXCLUDED.ended_at, tracks = EXCLUDED.tracks, ms = EXCLUDED.ms;
+                    """
+                    async with self.pool.connection() as conn:
+                        async with conn.cursor() as cursor:
+                            if pending:
+                                await cursor.execute("INSERT INTO artists (name) SELECT DISTINCT unnest(%s::text[]) ON CONFLICT (name) DO NOTHING;", (names,))
+                                await cursor.execute(query, params + [play_ids, names, positions])
+                                #sketches of the days (and accounts) of the plays are rebuilt from the rollups updated by the trigger
+                                pairs = sorted({(play['played_at'].astimezone(ZoneInfo(self.timezone)).date(), play['account']) for play, version in pending})
+                                for kind, source in SKETCH_SOURCES.items():
+                                    await cursor.execute(source, source_params(pairs))
+                                    await cursor.executemany(UPSERT, build_sketches(kind, pairs, await cursor.fetchall(), self.config["sketch_capacity"]))
+                            if sessions:
+                                await cursor.execute(session_query, session_params)
+                    spool.mark_synced(pending)
+                    spool.mark_sessions_synced(sessions)
+                    print(f"Copied {len(pending)} record(s) and {len(sessions)} session(s) to database.\n")
+                delay = self.flush_interval
+            except Exception as e: #database not available, plays stay in the spool
+                self.log_error(str(e), str(type(e).__name__))
+                await asyncio.sleep(delay)
+                delay = min(delay*2, 600)
+
+    async def handle_queue(self, listener, current_id, next_tracks):
         try:
-            artists = []
-            #get current playback state
-            current = sp.current_user_playing_track()
-            if current is not None:
-                if current['is_playing']:
-                    for artist in current['item']['artists']:
-                        artists.append(artist['name'])
-                    current_id = current.get('item', {}).get('id', None)
-                    song = current['item']['name']
-                    progress = current['progress_ms']
-                    duration = current['item']['duration_ms']
-                    record = {
-                        "artists": artists,
-                        "name": song,
-                        "progress": progress,
-                        "duration": duration 
-                    }
-
-                    insert_record(record)
-                    
-                    #queue handling
-                    if queue_config:
-                        if current_id: #songs without id cannot be queued
-                            for combo in queue_combos:
-                                #ensure the song is added once
-                                if last_song!=current_id:
-                                    last_song = current_id
-                                    added = False
-                                
-                                if not added:
-                                    if current_id in combo['currentTrack']:
-                                        users_queue = sp.queue()
-                                        next_song = users_queue['queue'][0]['id']
-                                        if not next_song==combo['nextTrack']:
-                                            sp.add_to_queue(combo['nextTrack'])
-                                        added = True
-                                        break
-                    await asyncio.sleep(5)
-                else: #false when paused
-                    await asyncio.sleep(30)
-            else: #playback not available or active
-                await asyncio.sleep(60)
-        #handle errors
-        #Spotify specific errors
+            upcoming = listener.queue_snapshot.get(current_id)
+            if upcoming is None:
+                users_queue = await listener.sp.queue()
+                upcoming = [item['id'] for item in users_queue['queue'] if item]
+            #tracks that are already at the front of the queue are not added again
+            queued = 0
+            while queued<len(next_tracks) and queued<len(upcoming) and upcoming[queued]==next_tracks[queued]:
+                queued += 1
+            for track in next_tracks[queued:]:
+                await listener.sp.add_to_queue(track)
+            listener.queue_snapshot.set(current_id, next_tracks + upcoming[queued:])
         except SpotifyException as e:
             status = getattr(e, 'http_status', 'N/A')
-            log_error(str(e), str(status))
-            print("Spotify exception caught. Check error log.\n")
-            await asyncio.sleep(15)
-        #all other errors
+            self.log_error(str(e), str(status), listener.account)
         except Exception as e:
-            log_error(str(e), str(type(e).__name__))
-            print("Exception caught. Check error log.\n")
-            await asyncio.sleep(15)
-            
-async def main():
-    await asyncio.gather(
-        get_data()
-    )
-
-asyncio.run(main())
+            self.log_error(str(e), str(type(e).__name__), listener.account)
+
+    async def get_data(self, listener, delay=0):
+        #spread requests of different accounts over the polling interval
+        await asyncio.sleep(delay)
+        while True:
+            try:
+                artists = []
+                #get current playback state
+                listener.scheduler.poll()
+                current = await listener.sp.current_user_playing_track()
+                if current is not None:
+                    if current['is_playing']:
+                        for artist in current['item']['artists']:
+                            artists.append(artist['name'])
+                        current_id = current.get('item', {}).get('id', None)
+                        song = current['item']['name']
+                        progress = current['progress_ms']
+                        duration = current['item']['duration_ms']
+                        record = {
+                            "artists": artists,
+                            "name": song,
+                            "progress": progress,
+                            "duration": duration
+                        }
+
+                        await self.insert_record(listener, record)
+
+                        #queue handling
+                        #songs without id cannot be queued; rules are checked once per song
+                        if current_id and listener.last_song!=current_id:
+                            listener.last_song = current_id
+                            next_tracks = self.queue_rules.next_tracks(current_id)
+                            if next_tracks:
+                                task = asyncio.create_task(self.handle_queue(listener, current_id, next_tracks))
+                                self.background_tasks.add(task)
+                                task.add_done_callback(self.background_tasks.discard)
+                        await asyncio.sleep(listener.scheduler.playing(progress, duration, current_id or song))
+                    else: #false when paused
+                        self.drain_event.set()
+                        await asyncio.sleep(listener.scheduler.paused())
+                else: #playback not available or active
+                    self.drain_event.set()
+                    await asyncio.sleep(listener.scheduler.inactive())
+            #handle errors
+            #Spotify specific errors
+            except SpotifyException as e:
+                status = getattr(e, 'http_status', 'N/A')
+                self.log_error(str(e), str(status), listener.account)
+                retry_after = (getattr(e, 'headers', None) or {}).get('Retry-After')
+                await asyncio.sleep(listener.scheduler.error(float(retry_after) if retry_after else None))
+            #all other errors
+            except Exception as e:
+                self.log_error(str(e), str(type(e).__name__), listener.account)
+                await asyncio.sleep(listener.scheduler.error())
+
+    #requests sent to Spotify during the last hour, per account
+    async def report_metrics(self):
+        metrics_file = self.config["metrics_file"]
+        while True:
+            await asyncio.sleep(60)
+            lines = ["# TYPE spotify_logger_polls_per_hour gauge"]
+            for listener in self.listeners:
+                lines.append(f'spotify_logger_polls_per_hour{{account="{listener.account}"}} {listener.scheduler.polls_per_hour()}')
+            try:
+                temp = metrics_file + ".tmp"
+                with open(temp, 'w') as file:
+                    file.write("\n".join(lines) + "\n")
+                os.replace(temp, metrics_file)
+            except OSError as e:
+                print(f"Metrics couldn't be written: {e}\n")
+
+    #with warm-up, the first database connection is established before polling starts;
+    #otherwise connections are made in the background and plays wait in the spool until then
+    async def open(self):
+        if self.own_pool:
+            await self.pool.open(wait=self.config["warmup"])
+
+    async def close(self):
+        await self.error_sink.flush(everything=True)
+        if self.http_client is not None:
+            await self.http_client.aclose()
+        if self.own_pool:
+            await self.pool.close()
+        if self.own_spool:
+            self.spool.close()
+
+    async def run(self):
+        await self.open()
+        try:
+            #authorize accounts one by one, a missing token requires user interaction
+            for listener in self.listeners:
+                await listener.sp.get_token()
+            await asyncio.gather(
+                *[self.get_data(listener, 5*i/len(self.listeners)) for i, listener in enumerate(self.listeners)],
+                self.drain_spool(),
+                self.error_sink.run(),
+                *([self.report_metrics()] if self.config["metrics_file"] else [])
+            )
+        finally:
+            await self.close()
+
+def main():
+    asyncio.run(Worker().run())
+
+if __name__ == '__main__':
+    main()
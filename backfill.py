@@ -0,0 +1,130 @@
+import argparse
+import os
+import psycopg
+import tzlocal
+from dotenv import load_dotenv
+from sketches import SKETCH_SOURCES, UPSERT, build_sketches, source_params
+
+load_dotenv()
+
+#rebuilds tables derived from "history" (normally maintained as records are written)
+
+#use time zone from the environment if set; otherwise default to system time zone
+if 'IANA_TIMEZONE' in os.environ:
+    current_timezone = os.environ['IANA_TIMEZONE']
+else:
+    current_timezone = tzlocal.get_localzone_name()
+
+#a pause longer than SESSION_GAP seconds ends a listening session
+session_gap = float(os.environ.get('SESSION_GAP', 1800))
+#items kept in the daily top-K sketches (see sketches.py)
+sketch_capacity = int(os.environ.get('SKETCH_CAPACITY', 200))
+
+#----------------------------------------------DB CONNECTION-----------------------------------------------------------
+#using cloud hosted PostgreSQL database
+host = os.environ['DB_HOST']
+db_name = os.environ['DB_NAME']
+user = os.environ['DB_USER']
+password = os.environ['DB_PASSWORD']
+port = os.environ['DB_PORT']
+
+conninfo = f"host={host} port={port} dbname={db_name} user={user} password={password} sslmode='require'"
+
+#daily rollups (migrations/005-add-daily-rollups.py) and the daily sketches built from them
+def backfill_rollups(conn):
+    with conn.cursor() as cursor:
+        #writes to "history" wait until the rollups are rebuilt, so no change is counted twice or lost
+        cursor.execute("LOCK TABLE history IN SHARE MODE;")
+        cursor.execute("TRUNCATE daily_track_stats, daily_artist_stats;")
+        query = f"""
+            INSERT INTO daily_track_stats (day, account, artist1, artist2, artist3, track_name, streams, ms)
+            SELECT (played_at AT TIME ZONE '{current_timezone}')::date, account, artist1, artist2, artist3, track_name,
+                COUNT(*) FILTER (WHERE progress >= 45000), COALESCE(SUM(progress), 0)
+            FROM history
+            GROUP BY 1, account, artist1, artist2, artist3, track_name;
+        """
+        cursor.execute(query)
+        tracks = cursor.rowcount
+        query = f"""
+            INSERT INTO daily_artist_stats (day, account, artist, streams, ms)
+            SELECT (h.played_at AT TIME ZONE '{current_timezone}')::date, h.account, a.name,
+                COUNT(*) FILTER (WHERE h.progress >= 45000), COALESCE(SUM(h.progress), 0)
+            FROM history h
+            JOIN history_artists ha ON ha.history_id = h.id
+            JOIN artists a ON a.id = ha.artist_id
+            GROUP BY 1, h.account, a.name;
+        """
+        cursor.execute(query)
+        artists = cursor.rowcount
+        #the sketches are built from the rollups
+        days = rebuild_sketches(cursor)
+    conn.commit()
+    print(f"Rollups rebuilt: {tracks} track days, {artists} artist days, sketches of {days} days.")
+
+#listening sessions (migrations/009-add-sessions.py) of history recorded before the worker maintained them:
+#plays before the first session of every account, split where the pause between plays is longer than SESSION_GAP;
+#running it again adds nothing
+def backfill_sessions(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("LOCK TABLE sessions IN SHARE ROW EXCLUSIVE MODE;")
+        query = """
+            INSERT INTO sessions (session_id, account, started_at, ended_at, tracks, ms)
+            SELECT gen_random_uuid(), account, min(played_at), max(played_at + progress * interval '1 millisecond'), COUNT(*), COALESCE(SUM(progress), 0)
+            FROM (
+                SELECT account, played_at, progress,
+                    SUM(new_session) OVER (PARTITION BY account ORDER BY played_at) as session
+                FROM (
+                    SELECT h.account, h.played_at, h.progress,
+                        CASE WHEN h.played_at - lag(h.played_at + h.progress * interval '1 millisecond') OVER (PARTITION BY h.account ORDER BY h.played_at)
+                            <= %s * interval '1 second' THEN 0 ELSE 1 END as new_session
+                    FROM history h
+                    WHERE h.played_at < COALESCE((SELECT min(s.started_at) FROM sessions s WHERE s.account = h.account), 'infinity')
+                ) as plays
+            ) as grouped
+            GROUP BY account, session;
+        """
+        cursor.execute(query, (session_gap,))
+        sessions = cursor.rowcount
+        #"sessions" has no notify trigger; without a payload, STATS drops all cached responses (see result_cache.py)
+        if sessions:
+            cursor.execute("NOTIFY history_changed;")
+    conn.commit()
+    print(f"Sessions added: {sessions}.")
+
+#sketches of all days (per account) of the daily rollups, about a month at a time (history must be locked by the caller)
+def rebuild_sketches(cursor):
+    cursor.execute("TRUNCATE daily_sketches;")
+    cursor.execute("SELECT DISTINCT day, account FROM daily_track_stats ORDER BY day, account;")
+    pairs = [tuple(row) for row in cursor.fetchall()]
+    for i in range(0, len(pairs), 31):
+        batch = pairs[i:i+31]
+        for kind, source in SKETCH_SOURCES.items():
+            cursor.execute(source, source_params(batch))
+            cursor.executemany(UPSERT, build_sketches(kind, batch, cursor.fetchall(), sketch_capacity))
+    return len({day for day, account in pairs})
+
+#daily sketches (migrations/010-add-daily-sketches.py), rebuilt from the daily rollups
+def backfill_sketches(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("LOCK TABLE history IN SHARE MODE;")
+        days = rebuild_sketches(cursor)
+    conn.commit()
+    print(f"Sketches rebuilt: {days} days.")
+
+backfills = {
+    "rollups": backfill_rollups,
+    "sessions": backfill_sessions,
+    "sketches": backfill_sketches
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild tables derived from history.")
+    parser.add_argument('tables', nargs='+', choices=list(backfills), help="tables to rebuild")
+    args = parser.parse_args()
+
+    with psycopg.connect(conninfo) as conn:
+        for table in args.tables:
+            backfills[table](conn)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import argparse
+import random
+import time
+from werkzeug.datastructures import MultiDict
+from benchmarks.results import write_results
+from query_compiler import QueryCompiler
+from stats_encoding import ARROW, MSGPACK, available_formats, build_rows, encode, encode_json
+from stats_format import build_result, dumps
+
+#per-row cost of turning query rows into a STATS response, without a database: the dict based path
+#(dict(zip()), format_row, stdlib JSON) against stats_encoding (row encoders, orjson if installed), and the
+#alternate formats that are installed; the JSON of both paths is checked to be identical
+#python -m benchmarks.encoding --rows 100000 --output encoding.json
+
+REQUESTS = {
+    "top tracks by streams": ("streams", {"type": "tracks"}, ["streams", "artist1", "artist2", "artist3", "track_name"]),
+    "top artists by duration": ("duration", {"type": "artists"}, ["ms", "artist"]),
+    "top tracks of an artist by duration": ("duration", {"artist": "Artist 0"}, ["ms", "track_name"])
+}
+
+#rows as returned by the query shape, with some featuring artists; "non_ascii" is the share of non-ASCII names
+#(a response with any of them is written by the stdlib encoder, see stats_encoding.encode_json)
+def synthetic_rows(rng, columns, count, non_ascii):
+    names = ["Beyoncé", "Sigur Rós", "Мумий Тролль", "坂本龍一"]
+
+    def name(i):
+        return f"{rng.choice(names)} {i}" if rng.random()<non_ascii else f"Artist {i}"
+
+    rows = []
+    for i in range(count):
+        row = []
+        for column in columns:
+            if column in ['streams', 'ms']:
+                row.append(rng.randint(1, 10**4) * (1000 if column=="ms" else 1))
+            elif column in ['artist2', 'artist3']:
+                row.append(name(i) if rng.random()<0.2 else None)
+            else:
+                row.append(name(i))
+        rows.append(tuple(row))
+    return rows
+
+#best of "repeat" runs, in microseconds per row
+def per_row(function, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter()-started
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best/len(rows)*1e6, 3)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the per-row cost of encoding STATS responses.")
+    parser.add_argument('--rows', type=int, default=100000, help="rows per response")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per measurement (the best one is reported)")
+    parser.add_argument('--non-ascii', type=float, default=0, help="share of non-ASCII artist and track names")
+    parser.add_argument('--seed', type=int, default=1, help="random seed")
+    parser.add_argument('--output', help="JSON file for the results")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    compiler = QueryCompiler("UTC")
+    results = {}
+    for name, (endpoint, request_args, columns) in REQUESTS.items():
+        req = compiler.parse(endpoint, MultiDict({**request_args, "limit": "0"}))
+        shape, params = compiler.bind(endpoint, req)
+        rows = synthetic_rows(rng, columns, args.rows, args.non_ascii)
+
+        def reference():
+            result, next_page = build_result(endpoint, req, shape, params, [dict(zip(columns, row)) for row in rows])
+            return dumps(result)
+
+        def encoded():
+            result, next_page = build_rows(endpoint, req, shape, params, columns, rows)
+            return encode_json(result)
+
+        if reference()!=encoded():
+            raise SystemExit(f"{name}: encoded JSON differs from the reference")
+        results[name] = {"dict_path_us_per_row": per_row(reference, rows, args.repeat),
+                         "encoded_us_per_row": per_row(encoded, rows, args.repeat)}
+        for mimetype, label in [(MSGPACK, "msgpack_us_per_row"), (ARROW, "arrow_us_per_row")]:
+            if mimetype in available_formats():
+                results[name][label] = per_row(lambda: encode(build_rows(endpoint, req, shape, params, columns, rows)[0], mimetype), rows, args.repeat)
+        print(f"{name}: {results[name]}")
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key!="output"}
+        write_results(args.output, "encoding", settings, results)
+
+if __name__ == '__main__':
+    main()
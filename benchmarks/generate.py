@@ -0,0 +1,158 @@
+import argparse
+import bisect
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+import psycopg
+from dotenv import load_dotenv
+from backfill import backfill_rollups, backfill_sketches
+from benchmarks.results import write_results
+
+load_dotenv()
+
+#deterministic synthetic listening history for benchmarks, loaded with COPY into the database set by DB_* variables
+#(use a separate database, not the production one; the schema must be migrated with migrate.py first)
+#artists and their tracks are picked with a Zipf-like skew, some tracks have featuring artists, some plays are
+#replays of the previous track, skipped before 45 seconds or stopped early, and plays are grouped into sessions
+#python -m benchmarks.generate --rows 1000000
+
+#----------------------------------------------DB CONNECTION-----------------------------------------------------------
+host = os.environ['DB_HOST']
+db_name = os.environ['DB_NAME']
+user = os.environ['DB_USER']
+password = os.environ['DB_PASSWORD']
+port = os.environ['DB_PORT']
+
+conninfo = f"host={host} port={port} dbname={db_name} user={user} password={password} sslmode='require'"
+
+def zipf_weights(count, skew):
+    weights = []
+    total = 0
+    for rank in range(count):
+        total += 1/(rank+1)**skew
+        weights.append(total)
+    return weights
+
+def pick(rng, weights):
+    return bisect.bisect_left(weights, rng.random()*weights[-1])
+
+class Catalog:
+    def __init__(self, rng, artists, tracks_per_artist, skew):
+        self.artists = [f"Artist {i}" for i in range(artists)]
+        self.artist_weights = zipf_weights(artists, skew)
+        self.track_weights = zipf_weights(tracks_per_artist, skew)
+        #tracks[artist][k] = (artists of the track, name, duration)
+        self.tracks = []
+        for i in range(artists):
+            tracks = []
+            for k in range(tracks_per_artist):
+                names = [self.artists[i]]
+                featuring = 2 if rng.random()<0.05 else 1 if rng.random()<0.2 else 0
+                while len(names)<1+featuring:
+                    other = self.artists[pick(rng, self.artist_weights)]
+                    if other not in names:
+                        names.append(other)
+                tracks.append((names, f"Track {i}-{k}", rng.randint(90000, 360000)))
+            self.tracks.append(tracks)
+
+    def track(self, rng):
+        return self.tracks[pick(rng, self.artist_weights)][pick(rng, self.track_weights)]
+
+#(record, artists of the record) for every play; the same seed always gives the same plays
+def plays(seed, rows, first_id, start, account, artists, tracks_per_artist, skew):
+    rng = random.Random(seed)
+    catalog = Catalog(rng, artists, tracks_per_artist, skew)
+    played_at = start
+    previous = None
+    for i in range(rows):
+        if previous and rng.random()<0.1: #replay
+            track = previous
+        else:
+            track = catalog.track(rng)
+        names, name, duration = track
+        r = rng.random()
+        if r<0.7:
+            progress = duration
+        elif r<0.9: #skipped, not a stream
+            progress = rng.randint(1000, 44999)
+        else:
+            progress = rng.randint(45000, duration)
+        padded = (names + [None, None])[:3]
+        yield (first_id+i, account, padded[0], padded[1], padded[2], name, played_at, progress, duration), names
+        previous = track
+        played_at += timedelta(milliseconds=progress + rng.randint(0, 3000))
+        if rng.random()<0.05: #end of a session
+            played_at += timedelta(hours=rng.uniform(1, 12))
+
+def generate(args):
+    settings = vars(args)
+    artists = max(10, args.rows//2000)
+    start = datetime.fromisoformat(args.start).replace(tzinfo=timezone.utc)
+    started = time.perf_counter()
+    with psycopg.connect(conninfo) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT COALESCE(max(id), 0) + 1 FROM history;")
+            first_id = cursor.fetchone()[0]
+            #rollups are rebuilt once after the load instead of row by row
+            cursor.execute("ALTER TABLE history DISABLE TRIGGER USER;")
+            cursor.execute("ALTER TABLE history_artists DISABLE TRIGGER USER;")
+
+            cursor.execute("CREATE TEMP TABLE bench_artists (name text) ON COMMIT DROP;")
+            with cursor.copy("COPY bench_artists (name) FROM STDIN") as copy:
+                for i in range(artists):
+                    copy.write_row((f"Artist {i}",))
+            cursor.execute("INSERT INTO artists (name) SELECT name FROM bench_artists ON CONFLICT (name) DO NOTHING;")
+            cursor.execute("SELECT name, id FROM artists WHERE name IN (SELECT name FROM bench_artists);")
+            artist_ids = dict(cursor.fetchall())
+
+            generated = plays(args.seed, args.rows, first_id, start, args.account, artists, args.tracks_per_artist, args.skew)
+            with cursor.copy("COPY history (id, account, artist1, artist2, artist3, track_name, played_at, progress, duration) FROM STDIN") as copy:
+                for record, names in generated:
+                    copy.write_row(record)
+            loaded = time.perf_counter()
+
+            #second pass over the same plays for "history_artists"
+            generated = plays(args.seed, args.rows, first_id, start, args.account, artists, args.tracks_per_artist, args.skew)
+            with cursor.copy("COPY history_artists (history_id, artist_id, position) FROM STDIN") as copy:
+                for record, names in generated:
+                    for position, name in enumerate(names, 1):
+                        copy.write_row((record[0], artist_ids[name], position))
+            cursor.execute("SELECT setval(pg_get_serial_sequence('history', 'id'), (SELECT max(id) FROM history));")
+            cursor.execute("ALTER TABLE history ENABLE TRIGGER USER;")
+            cursor.execute("ALTER TABLE history_artists ENABLE TRIGGER USER;")
+        conn.commit()
+        bridged = time.perf_counter()
+        backfill_rollups(conn)
+        backfill_sketches(conn)
+        with conn.cursor() as cursor:
+            cursor.execute("ANALYZE history; ANALYZE history_artists; ANALYZE daily_track_stats; ANALYZE daily_artist_stats; ANALYZE daily_sketches;")
+        conn.commit()
+    finished = time.perf_counter()
+
+    results = {
+        "rows": args.rows,
+        "artists": artists,
+        "history_copy_s": round(loaded-started, 2),
+        "history_artists_copy_s": round(bridged-loaded, 2),
+        "rollups_s": round(finished-bridged, 2),
+        "rows_per_s": round(args.rows/(loaded-started), 1)
+    }
+    print(results)
+    if args.output:
+        write_results(args.output, "generate", settings, results)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load synthetic listening history for benchmarks.")
+    parser.add_argument('--rows', type=int, default=1000000, help="number of plays")
+    parser.add_argument('--seed', type=int, default=1, help="random seed (the same seed gives the same history)")
+    parser.add_argument('--start', default="2015-01-01", help="time of the first play (UTC)")
+    parser.add_argument('--account', default="default", help="account of the plays")
+    parser.add_argument('--tracks-per-artist', type=int, default=20, help="tracks of every artist")
+    parser.add_argument('--skew', type=float, default=1.1, help="Zipf exponent of artist and track popularity")
+    parser.add_argument('--output', help="JSON file for load timings")
+    args = parser.parse_args()
+    generate(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import argparse
+import asyncio
+import time
+import httpx
+from benchmarks.results import latency, write_results
+
+#load driver for the STATS endpoints: every parameter combination of the README's filtering tables
+#(with and without a date range) is requested --requests times by --concurrency clients
+#run STATS with STATS_CACHE_SIZE=0 to measure the queries rather than the result cache
+#python -m benchmarks.load --url http://127.0.0.1:5000 --output load.json
+
+def combinations(artist, track, start, end):
+    result = {}
+    selections = {
+        "top artists": {"type": "artists"},
+        "top tracks": {"type": "tracks"},
+        "top tracks by artist": {"artist": artist},
+        "track": {"artist": artist, "track": track}
+    }
+    date_range = {"startDate": start, "endDate": end}
+    for endpoint in ['streams', 'duration', 'summary']:
+        for name, params in selections.items():
+            result[f"{endpoint}: {name}"] = (f"/statistics/{endpoint}", params)
+            result[f"{endpoint}: {name}, date range"] = (f"/statistics/{endpoint}", {**params, **date_range})
+    for endpoint in ['streams', 'duration']:
+        for name in ['top artists', 'top tracks']: #merged daily sketches instead of the rollups
+            result[f"{endpoint}: {name}, approx"] = (f"/statistics/{endpoint}", {**selections[name], "approx": "true"})
+            result[f"{endpoint}: {name}, date range, approx"] = (f"/statistics/{endpoint}", {**selections[name], **date_range, "approx": "true"})
+    result["total"] = ("/statistics/total", {})
+    result["total: date range"] = ("/statistics/total", date_range)
+    result["total: artist"] = ("/statistics/total", {"artist": artist})
+    result["total: artist, date range"] = ("/statistics/total", {"artist": artist, **date_range})
+    return result
+
+async def run(client, path, params, requests, concurrency):
+    durations = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining>0:
+            remaining -= 1
+            started = time.perf_counter()
+            try:
+                response = await client.get(path, params=params)
+                if response.status_code!=200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            durations.append(time.perf_counter()-started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    result = latency(durations, time.perf_counter()-started)
+    result["errors"] = errors
+    return result
+
+async def main_async(args):
+    results = {}
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+        for name, (path, params) in combinations(args.artist, args.track, args.start, args.end).items():
+            if args.only and args.only not in name:
+                continue
+            results[name] = await run(client, path, params, args.requests, args.concurrency)
+            print(f"{name}: {results[name]}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure latency and throughput of the STATS endpoints.")
+    parser.add_argument('--url', default="http://127.0.0.1:5000", help="STATS base URL")
+    parser.add_argument('--requests', type=int, default=200, help="requests per combination")
+    parser.add_argument('--concurrency', type=int, default=8, help="concurrent clients")
+    parser.add_argument('--timeout', type=float, default=60, help="request timeout in seconds")
+    parser.add_argument('--artist', default="Artist 0", help="artist used by artist filters (the most played one of the generated history)")
+    parser.add_argument('--track', default="Track 0-0", help="track used by track filters")
+    parser.add_argument('--start', default="2016-01-01", help="start of the date range")
+    parser.add_argument('--end', default="2016-12-31", help="end of the date range")
+    parser.add_argument('--only', help="run only combinations containing this text")
+    parser.add_argument('--output', help="JSON file for the results")
+    args = parser.parse_args()
+
+    results = asyncio.run(main_async(args))
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key!="output"}
+        write_results(args.output, "load", settings, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import tempfile
+import time
+from benchmarks.results import latency, write_results
+from WORKER import Worker, worker_config
+
+#worker replay harness: feeds recorded playback states (a JSON list of responses of Spotify's
+#"currently playing" endpoint, null for no playback) through Worker.insert_record with a stubbed Spotify client
+#plays go to a temporary spool; with --drain they are also copied to the database (DB_* variables)
+#python -m benchmarks.replay recording.json --output replay.json
+
+#stands in for the database pool without --drain, the worker never connects
+#(and doesn't open or close a pool it was given)
+class NoDatabase:
+    pass
+
+#replays recorded responses instead of calling Spotify
+class ReplaySpotify:
+    def __init__(self, responses):
+        self.responses = iter(responses)
+
+    async def current_user_playing_track(self):
+        return next(self.responses)
+
+    async def queue(self):
+        return {"queue": []}
+
+    async def add_to_queue(self, track):
+        pass
+
+async def replay(responses, drain):
+    #plays go to a temporary spool; the database is set by the DB_* variables and only used with --drain
+    spool_dir = tempfile.mkdtemp(prefix="replay-")
+    config = worker_config()
+    config.update(accounts=["replay"], spool_path=os.path.join(spool_dir, 'spool.db'))
+    spotify = ReplaySpotify(responses)
+    worker = Worker(config, pool=None if drain else NoDatabase(), spotify_factory=lambda account: spotify)
+    listener = worker.listeners[0]
+    if drain:
+        await worker.open()
+    else:
+        #the last play is not loaded from the database
+        listener.history_cache.last = None
+        listener.history_cache.loaded = True
+
+    durations = []
+    started = time.perf_counter()
+    for _ in range(len(responses)):
+        current = await listener.sp.current_user_playing_track()
+        if current is None or not current['is_playing']:
+            continue
+        record = {
+            "artists": [artist['name'] for artist in current['item']['artists']],
+            "name": current['item']['name'],
+            "progress": current['progress_ms'],
+            "duration": current['item']['duration_ms']
+        }
+        call = time.perf_counter()
+        await worker.insert_record(listener, record)
+        durations.append(time.perf_counter()-call)
+    results = {"insert_record": latency(durations, time.perf_counter()-started)}
+
+    if drain:
+        pending = len(worker.spool.pending(1000000))
+        started = time.perf_counter()
+        task = asyncio.create_task(worker.drain_spool())
+        worker.drain_event.set()
+        #the drainer retries with a backoff while the database is not available
+        while worker.spool.pending(1) and time.perf_counter()-started<600:
+            await asyncio.sleep(0.05)
+        task.cancel()
+        results["drain"] = {"plays": pending, "not_copied": len(worker.spool.pending(1000000)), "seconds": round(time.perf_counter()-started, 3)}
+        await worker.pool.close()
+    worker.spool.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded playback states through the worker.")
+    parser.add_argument('recording', help="JSON list of recorded playback states")
+    parser.add_argument('--repeat', type=int, default=1, help="times the recording is replayed")
+    parser.add_argument('--drain', action='store_true', help="also copy the plays to the database")
+    parser.add_argument('--output', help="JSON file for the results")
+    args = parser.parse_args()
+
+    with open(args.recording, 'r') as file:
+        responses = json.load(file)*args.repeat
+    #the worker's console output is not part of the measurement
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = asyncio.run(replay(responses, args.drain))
+    print(results)
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key!="output"}
+        write_results(args.output, "replay", settings, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import json
+import subprocess
+from datetime import datetime, timezone
+
+#benchmark results are written as JSON with the commit they were measured on, so runs can be compared
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, min(len(values)-1, round(p/100*len(values))-1))
+    return values[index]
+
+#latency summary (in milliseconds) of a list of durations in seconds
+def latency(durations, elapsed=None):
+    result = {
+        "count": len(durations),
+        "p50_ms": round(percentile(durations, 50)*1000, 3) if durations else None,
+        "p95_ms": round(percentile(durations, 95)*1000, 3) if durations else None,
+        "p99_ms": round(percentile(durations, 99)*1000, 3) if durations else None
+    }
+    if elapsed:
+        result["throughput_per_s"] = round(len(durations)/elapsed, 2)
+    return result
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_results(path, benchmark, settings, results):
+    data = {
+        "benchmark": benchmark,
+        "commit": commit(),
+        "date": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        "settings": settings,
+        "results": results
+    }
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=2)
+    print(f"Results written to {path}.")
@@ -0,0 +1,62 @@
+import argparse
+import json
+import subprocess
+import sys
+from benchmarks.results import write_results
+
+#startup time of STATS and the worker: importing the module and creating the app/worker, each in a new
+#interpreter (nothing is connected, so no database is needed); the median of --runs runs is reported
+#python -m benchmarks.startup --output startup.json
+
+#run in a new interpreter, prints the import and create times in seconds
+SCRIPT = """
+import json, os, sys, tempfile, time
+started = time.perf_counter()
+{imports}
+imported = time.perf_counter()
+{create}
+created = time.perf_counter()
+print(json.dumps({{"import_s": imported-started, "create_s": created-imported}}))
+"""
+
+#the pool is never opened, so any conninfo can be used
+CONFIG = "config.update(conninfo='host=127.0.0.1 dbname=startup')"
+
+TARGETS = {
+    "STATS": ("from STATS import create_app\nfrom stats_config import stats_config",
+              f"config = stats_config()\n{CONFIG}\ncreate_app(config)"),
+    "stats_asgi": ("from stats_asgi import create_app\nfrom stats_config import stats_config",
+                   f"config = stats_config()\n{CONFIG}\ncreate_app(config)"),
+    "WORKER": ("from WORKER import Worker, worker_config",
+               f"config = worker_config()\n{CONFIG}\nconfig.update(spool_path=os.path.join(tempfile.mkdtemp(), 'spool.db'))\nWorker(config)")
+}
+
+def measure(imports, create):
+    output = subprocess.run([sys.executable, "-c", SCRIPT.format(imports=imports, create=create)],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import and startup time of STATS and the worker.")
+    parser.add_argument('--runs', type=int, default=5, help="runs per target")
+    parser.add_argument('--output', help="JSON file for the results")
+    args = parser.parse_args()
+
+    results = {}
+    for name, (imports, create) in TARGETS.items():
+        runs = [measure(imports, create) for _ in range(args.runs)]
+        results[name] = {
+            "import_ms": round(median([run["import_s"] for run in runs])*1000, 1),
+            "create_ms": round(median([run["create_s"] for run in runs])*1000, 1)
+        }
+        print(f"{name}: {results[name]}")
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key!="output"}
+        write_results(args.output, "startup", settings, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import asyncio
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+#buffers errors in memory and writes them to "error_log" in batches
+#repeats of the same (type, description) within "window" seconds are collapsed into one record with a count,
+#so an error storm costs at most one record per distinct error per window
+class ErrorSink:
+    def __init__(self, pool, timezone, window=60, max_pending=1000):
+        self.pool = pool
+        self.timezone = timezone
+        self.window = window
+        self.max_pending = max_pending
+        self.open = {} #errors still collecting repeats
+        self.closed = [] #errors waiting to be written
+        self.dropped = 0
+
+    #never blocks: the error is only recorded in memory
+    def add(self, code, description):
+        now = datetime.now(ZoneInfo(self.timezone))
+        key = (code, description)
+        entry = self.open.get(key)
+        if entry:
+            entry['count'] += 1
+            entry['last_seen'] = now
+            return
+        if len(self.open) + len(self.closed) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.open[key] = {
+            "type": code,
+            "description": description,
+            "count": 1,
+            "first_seen": now,
+            "last_seen": now,
+            "opened": time.monotonic()
+        }
+        print(f"{now} Error: {code} {description}\n")
+
+    #close errors whose window has passed (all of them if "everything" is set)
+    def close(self, everything=False):
+        now = time.monotonic()
+        for key, entry in list(self.open.items()):
+            if everything or now-entry['opened']>=self.window:
+                self.closed.append(self.open.pop(key))
+        if self.dropped:
+            now = datetime.now(ZoneInfo(self.timezone))
+            if self.closed and self.closed[-1]['type']=="ErrorSink":
+                self.closed[-1]['count'] += self.dropped
+                self.closed[-1]['last_seen'] = now
+            else:
+                self.closed.append({"type": "ErrorSink", "description": "Too many errors, some were not logged.",
+                                    "count": self.dropped, "first_seen": now, "last_seen": now})
+            self.dropped = 0
+
+    async def flush(self, everything=False):
+        self.close(everything)
+        if not self.closed:
+            return
+        batch = self.closed
+        values = ", ".join(["(%s, %s, %s, %s, %s, %s)"]*len(batch))
+        query = f"INSERT INTO error_log (date, type, description, count, first_seen, last_seen) VALUES {values};"
+        params = []
+        for entry in batch:
+            params.extend([entry['first_seen'], entry['type'], entry['description'], entry['count'], entry['first_seen'], entry['last_seen']])
+        try:
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(query, params)
+            self.closed = self.closed[len(batch):]
+            print(f"Errors logged: {len(batch)}\n")
+        except Exception as e: #errors stay in memory (up to "max_pending") until the database is available
+            print(f"Errors couldn't be written to database: {e}\n")
+
+    async def run(self, interval=10):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
@@ -0,0 +1,126 @@
+import uuid
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+#in-memory copy of the last "history" row (the current play) of one account
+#decisions are made in memory and every change is written to the local spool,
+#from where it is copied to the database in batches (see Spool and drain_spool in WORKER.py)
+#plays are grouped into listening sessions, a pause longer than "session_gap" seconds starts a new session
+class HistoryCache:
+    def __init__(self, pool, spool, timezone, account="default", session_gap=1800):
+        self.pool = pool
+        self.spool = spool
+        self.timezone = timezone
+        self.account = account
+        self.session_gap = session_gap
+        self.last = None
+        self.session = None
+        self.loaded = False
+
+    #rebuild state (last play and session) from the spool and the database, whichever is newer
+    async def load(self):
+        last = self.spool.last_play(self.account)
+        session = self.spool.last_session(self.account)
+        query = "SELECT play_id, account, artist1, artist2, artist3, track_name, played_at, progress, duration FROM history WHERE account = %s ORDER BY played_at DESC LIMIT 1;"
+        session_query = "SELECT session_id, account, started_at, ended_at, tracks, ms FROM sessions WHERE account = %s ORDER BY started_at DESC LIMIT 1;"
+        try:
+            async with self.pool.connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(query, (self.account,))
+                    row = await cursor.fetchone()
+                    if row:
+                        columns = [desc[0] for desc in cursor.description]
+                        stored = dict(zip(columns, row))
+                        stored['play_id'] = str(stored['play_id'])
+                        stored['artists'] = [artist for artist in (stored['artist1'], stored['artist2'], stored['artist3']) if artist is not None]
+                        if last is None or stored['played_at']>last['played_at']:
+                            last = stored
+                    await cursor.execute(session_query, (self.account,))
+                    row = await cursor.fetchone()
+                    if row:
+                        columns = [desc[0] for desc in cursor.description]
+                        stored = dict(zip(columns, row))
+                        stored['session_id'] = str(stored['session_id'])
+                        if session is None or stored['started_at']>session['started_at']:
+                            session = stored
+        except Exception as e: #database not available, continue from the spool
+            print(f"{self.account}: last record couldn't be loaded from database: {e}\n")
+        self.last = last
+        self.session = session
+        self.loaded = True
+
+    def now(self):
+        return datetime.now(ZoneInfo(self.timezone))
+
+    #true if the last play could still be in progress
+    def is_recent(self, last):
+        difference = self.now() - last['played_at']
+        difference = difference.total_seconds() * 1000
+        return difference<last['duration']
+
+    def set_progress(self, progress):
+        if self.last['progress']!=progress:
+            self.extend_session(progress - self.last['progress'], self.last['played_at'] + timedelta(milliseconds=progress))
+            self.last['progress'] = progress
+            self.spool.write(self.last)
+
+    #add a new play to the current session, or start a new session after a gap
+    def add_to_session(self, played_at, progress):
+        session = self.session
+        if session is None or (played_at - session['ended_at']).total_seconds()>self.session_gap:
+            session = self.session = {
+                "session_id": str(uuid.uuid4()),
+                "account": self.account,
+                "started_at": played_at,
+                "ended_at": played_at,
+                "tracks": 0,
+                "ms": 0
+            }
+        session['tracks'] += 1
+        self.extend_session(progress, played_at + timedelta(milliseconds=progress))
+
+    #progress of a play in the current session changed by "ms"
+    def extend_session(self, ms, ended_at):
+        if self.session is None:
+            return
+        self.session['ms'] += ms
+        self.session['ended_at'] = max(self.session['ended_at'], ended_at)
+        self.spool.write_session(self.session)
+
+    #decide between same song, replay and new song; returns play_id of the current play
+    async def record(self, artists, name, progress, duration):
+        #up to 3 artists are kept in "history", all of them in "history_artists"
+        artist1, artist2, artist3 = (artists+[None]*3)[:3]
+        if artist1==None:
+            artist1 = "No artist"
+            artists = [artist1]
+        if not self.loaded:
+            await self.load()
+        last = self.last
+        if last:
+            if last['artist1']==artist1 and last['track_name']==name: #the same song playing
+                if last['progress']<=progress and self.is_recent(last):
+                    self.set_progress(progress)
+                    return last['play_id']
+                #song was replayed with less than 6s remaining (may happen due to 5s logging interval)
+                if last['duration']-last['progress']<6000 and self.is_recent(last):
+                    self.set_progress(last['duration'])
+            elif last['duration']-last['progress']<6000: #previous song had less than 6s remaining (may happen due to 5s logging interval)
+                self.set_progress(last['duration'])
+
+        #new song or replay, new record
+        self.last = {
+            "play_id": str(uuid.uuid4()),
+            "account": self.account,
+            "artist1": artist1,
+            "artist2": artist2,
+            "artist3": artist3,
+            "artists": artists,
+            "track_name": name,
+            "played_at": self.now(),
+            "progress": progress,
+            "duration": duration
+        }
+        self.spool.write(self.last)
+        self.add_to_session(self.last['played_at'], progress)
+        return self.last['play_id']
@@ -0,0 +1,186 @@
+import argparse
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import ijson
+import psycopg
+import tzlocal
+from dotenv import load_dotenv
+from sketches import SKETCH_SOURCES, UPSERT, build_sketches, source_params
+
+load_dotenv()
+
+#imports Spotify "extended streaming history" exports (Streaming_History_Audio_*.json) into "history"
+#files are parsed incrementally and loaded with COPY in batches into one staging table (in parallel), so memory use
+#does not depend on file size; the staged plays are then inserted month by month (in parallel);
+#plays that overlap an existing record of the same track (e.g. already logged by the worker) are skipped;
+#the daily rollups (trigger on "history") and sketches of the imported days are updated in the same transaction
+
+#use time zone from the environment if set; otherwise default to system time zone
+if 'IANA_TIMEZONE' in os.environ:
+    current_timezone = os.environ['IANA_TIMEZONE']
+else:
+    current_timezone = tzlocal.get_localzone_name()
+
+#items kept in the daily top-K sketches (see sketches.py)
+sketch_capacity = int(os.environ.get('SKETCH_CAPACITY', 200))
+
+#----------------------------------------------DB CONNECTION-----------------------------------------------------------
+#using cloud hosted PostgreSQL database
+host = os.environ['DB_HOST']
+db_name = os.environ['DB_NAME']
+user = os.environ['DB_USER']
+password = os.environ['DB_PASSWORD']
+port = os.environ['DB_PORT']
+
+conninfo = f"host={host} port={port} dbname={db_name} user={user} password={password} sslmode='require'"
+
+columns = ['account', 'artist1', 'track_name', 'played_at', 'progress', 'duration']
+
+#map an export entry to a "history" record; None for entries without a track (podcasts, audiobooks)
+def to_record(entry, account):
+    name = entry.get('master_metadata_track_name')
+    if not name:
+        return None
+    artist = entry.get('master_metadata_album_artist_name') or "No artist"
+    ms_played = int(entry.get('ms_played') or 0)
+    #"ts" is the time the playback ended
+    ended = datetime.fromisoformat(entry['ts'])
+    played_at = ended - timedelta(milliseconds=ms_played)
+    #track duration is not part of the export, the time played is the best estimate
+    return (account, artist, name, played_at, ms_played, ms_played)
+
+def read_records(path, account):
+    with open(path, 'rb') as file:
+        for entry in ijson.items(file, 'item'):
+            record = to_record(entry, account)
+            if record:
+                yield record
+
+#staging table of one run, shared by the processes of the run (unlogged: it is dropped at the end)
+def create_staging(conn):
+    staging = f"import_staging_{uuid.uuid4().hex[:12]}"
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE UNLOGGED TABLE {staging} (
+                account text, artist1 text, track_name text, played_at timestamptz, progress int8, duration int8
+            );
+        """)
+    conn.commit()
+    return staging
+
+#step 1, one process per file: parse the file and COPY its plays into the staging table in batches
+def stage_file(path, account, staging, batch_size):
+    read = 0
+    with psycopg.connect(conninfo) as conn:
+        batch = []
+        for record in read_records(path, account):
+            batch.append(record)
+            if len(batch)>=batch_size:
+                copy_batch(conn, staging, batch)
+                read += len(batch)
+                batch = []
+        if batch:
+            copy_batch(conn, staging, batch)
+            read += len(batch)
+    return path, read
+
+def copy_batch(conn, staging, batch):
+    with conn.cursor() as cursor:
+        with cursor.copy(f"COPY {staging} ({', '.join(columns)}) FROM STDIN") as copy:
+            for record in batch:
+                copy.write_row(record)
+    conn.commit()
+
+#months (local time) of the staged plays; every month is loaded in its own transaction
+def staged_months(conn, staging):
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE INDEX ON {staging} (played_at);")
+        cursor.execute(f"SELECT DISTINCT date_trunc('month', played_at AT TIME ZONE %s) FROM {staging} ORDER BY 1;", (current_timezone,))
+        months = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    return months
+
+#step 2, one process per month: insert the staged plays of the month into "history"
+#all files of the run are staged together, so plays that are in several files (overlapping exports) are inserted once;
+#months don't share days, so they are loaded in parallel without touching the same rollup or sketch rows;
+#the advisory lock only serializes another run loading the same account and month
+def load_month(account, staging, month):
+    with psycopg.connect(conninfo) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext('importer:' || %s || ':' || %s::text));", (account, month))
+            params = {"tz": current_timezone, "month": month}
+            in_month = "played_at >= %(month)s::timestamp AT TIME ZONE %(tz)s AND played_at < (%(month)s::timestamp + interval '1 month') AT TIME ZONE %(tz)s"
+            #sorted, so months inserting the same new artists wait for each other instead of deadlocking
+            cursor.execute(f"INSERT INTO artists (name) SELECT DISTINCT artist1 FROM {staging} WHERE {in_month} ORDER BY 1 ON CONFLICT (name) DO NOTHING;", params)
+            #skip plays that overlap a record of the same track (plays are at most a few hours long),
+            #and plays that are staged more than once
+            query = f"""
+                WITH inserted AS (
+                    INSERT INTO history (account, artist1, track_name, played_at, progress, duration)
+                    SELECT DISTINCT ON (s.account, s.track_name, s.played_at)
+                        s.account, s.artist1, s.track_name, s.played_at, s.progress, s.duration
+                    FROM {staging} s
+                    WHERE {in_month}
+                    AND NOT EXISTS (
+                        SELECT 1 FROM history h
+                        WHERE h.account = s.account
+                        AND h.track_name = s.track_name
+                        AND h.played_at >= s.played_at - interval '3 hours'
+                        AND h.played_at <= s.played_at + s.progress * interval '1 millisecond'
+                        AND h.played_at + h.progress * interval '1 millisecond' >= s.played_at
+                    )
+                    ORDER BY s.account, s.track_name, s.played_at, s.progress DESC
+                    RETURNING id, artist1
+                )
+                INSERT INTO history_artists (history_id, artist_id, position)
+                SELECT i.id, a.id, 1
+                FROM inserted i
+                JOIN artists a ON a.name = i.artist1;
+            """
+            cursor.execute(query, params)
+            inserted = cursor.rowcount
+            #the rollups are updated by the trigger on "history"; the sketches of the account's days of the month are rebuilt
+            #from them in the same transaction, as the worker does for the plays it drains
+            if inserted:
+                cursor.execute(f"SELECT DISTINCT (played_at AT TIME ZONE %(tz)s)::date FROM {staging} WHERE {in_month} ORDER BY 1;", params)
+                pairs = [(row[0], account) for row in cursor.fetchall()]
+                for kind, source in SKETCH_SOURCES.items():
+                    cursor.execute(source, source_params(pairs))
+                    cursor.executemany(UPSERT, build_sketches(kind, pairs, cursor.fetchall(), sketch_capacity))
+        conn.commit()
+    return inserted
+
+def main():
+    parser = argparse.ArgumentParser(description="Import Spotify extended streaming history into the database.")
+    parser.add_argument('files', nargs='+', help="Streaming_History_Audio_*.json files")
+    parser.add_argument('--account', default="default", help="account the history belongs to")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="files (then months) imported in parallel")
+    parser.add_argument('--batch-size', type=int, default=50000, help="records per COPY batch")
+    args = parser.parse_args()
+
+    with psycopg.connect(conninfo) as conn:
+        staging = create_staging(conn)
+        try:
+            read = 0
+            with ProcessPoolExecutor(max_workers=min(args.workers, len(args.files))) as executor:
+                futures = [executor.submit(stage_file, path, args.account, staging, args.batch_size) for path in args.files]
+                for future in as_completed(futures):
+                    path, file_read = future.result()
+                    read += file_read
+                    print(f"{path}: {file_read} plays read.")
+            months = staged_months(conn, staging)
+            inserted = 0
+            with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(months)))) as executor:
+                for month_inserted in executor.map(load_month, [args.account]*len(months), [staging]*len(months), months):
+                    inserted += month_inserted
+            print(f"{read} plays read, {inserted} imported, {read-inserted} already logged or in several files.")
+        finally:
+            conn.rollback()
+            with conn.cursor() as cursor:
+                cursor.execute(f"DROP TABLE IF EXISTS {staging};")
+            conn.commit()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import glob
+import importlib.util
+import os
+import re
+import psycopg
+import tzlocal
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#applies migrations from "migrations/" in order and records them in "schema_version"
+#a migration is either NNN-name.py with a function statements(timezone) returning SQL statements, or NNN-name.sql;
+#every migration runs in one transaction, except migrations using CREATE INDEX CONCURRENTLY,
+#which run statement by statement (outside of a transaction) so the worker's inserts are not blocked
+
+#use time zone from the environment if set; otherwise default to system time zone
+if 'IANA_TIMEZONE' in os.environ:
+    current_timezone = os.environ['IANA_TIMEZONE']
+else:
+    current_timezone = tzlocal.get_localzone_name()
+
+#----------------------------------------------DB CONNECTION-----------------------------------------------------------
+#using cloud hosted PostgreSQL database
+host = os.environ['DB_HOST']
+db_name = os.environ['DB_NAME']
+user = os.environ['DB_USER']
+password = os.environ['DB_PASSWORD']
+port = os.environ['DB_PORT']
+
+conninfo = f"host={host} port={port} dbname={db_name} user={user} password={password} sslmode='require'"
+
+migrations_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+#queries shaped like the STATS queries, used by --explain to check which indexes are used
+explain_queries = {
+    "top tracks in a date range": """
+        SELECT COUNT(*) as streams, artist1, artist2, artist3, track_name FROM history
+        WHERE progress>=45000 AND played_at >= now() - interval '30 days'
+        GROUP BY artist1, artist2, artist3, track_name ORDER BY streams DESC LIMIT 20
+    """,
+    "top tracks by artist": """
+        SELECT COUNT(*) as streams, track_name FROM history
+        WHERE progress>=45000 AND id IN (SELECT ha.history_id FROM history_artists ha JOIN artists a ON a.id = ha.artist_id WHERE a.name = (SELECT name FROM artists LIMIT 1))
+        GROUP BY track_name ORDER BY streams DESC LIMIT 20
+    """,
+    "track name prefix": """
+        SELECT SUM(progress) as ms, track_name FROM history
+        WHERE track_name LIKE (SELECT left(track_name, 3) FROM history LIMIT 1) || '%'
+        GROUP BY track_name
+    """,
+    "total streaming time in a date range": """
+        SELECT SUM(progress) as ms FROM history WHERE played_at >= now() - interval '1 day'
+    """
+}
+
+def load_migrations():
+    migrations = []
+    for path in sorted(glob.glob(os.path.join(migrations_dir, '[0-9][0-9][0-9]-*'))):
+        name = os.path.basename(path)
+        version = int(name[:3])
+        if path.endswith('.py'):
+            spec = importlib.util.spec_from_file_location(f"migration_{version}", path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            statements = module.statements(current_timezone)
+        elif path.endswith('.sql'):
+            with open(path, 'r') as file:
+                statements = [file.read()]
+        else:
+            continue
+        migrations.append((version, name, statements))
+    return migrations
+
+def is_concurrent(statements):
+    return any(re.search(r"\bCONCURRENTLY\b", statement, re.IGNORECASE) for statement in statements)
+
+#names of the indexes built with CREATE INDEX CONCURRENTLY by the statements
+def concurrent_indexes(statements):
+    pattern = r"\bCREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)"
+    return [name for statement in statements for name in re.findall(pattern, statement, re.IGNORECASE)]
+
+#split SQL into single statements (only for non-transactional migrations, which hold plain DDL)
+def split_statements(statements):
+    result = []
+    for statement in statements:
+        for part in statement.split(';'):
+            lines = [line for line in part.splitlines() if line.strip() and not line.strip().startswith('--')]
+            if lines:
+                result.append("\n".join(lines))
+    return result
+
+def applied_versions(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version int4 PRIMARY KEY,
+                name text NOT NULL,
+                applied_at timestamptz NOT NULL DEFAULT now()
+            );
+        """)
+        conn.commit()
+        cursor.execute("SELECT version FROM schema_version;")
+        versions = {row[0] for row in cursor.fetchall()}
+        conn.commit()
+        return versions
+
+def record_version(cursor, version, name):
+    cursor.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s);", (version, name))
+
+def apply(conn, version, name, statements):
+    if not is_concurrent(statements):
+        with conn.transaction():
+            with conn.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+                record_version(cursor, version, name)
+        return
+
+    #CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            for statement in split_statements(statements):
+                cursor.execute(statement)
+            #a failed concurrent build leaves an invalid index behind (which IF NOT EXISTS then skips);
+            #only the indexes of this migration are checked, in the current schema
+            cursor.execute("""
+                SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE NOT i.indisvalid AND c.relnamespace = current_schema()::regnamespace AND c.relname = ANY(%s);
+            """, ([name.lower() for name in concurrent_indexes(statements)],))
+            invalid = [row[0] for row in cursor.fetchall()]
+            if invalid:
+                raise RuntimeError(f"Invalid indexes after {name}: {', '.join(invalid)}. Drop them and run the migration again.")
+            record_version(cursor, version, name)
+    finally:
+        conn.autocommit = False
+
+def explain(conn):
+    with conn.cursor() as cursor:
+        for title, query in explain_queries.items():
+            print(f"-- {title}")
+            try:
+                cursor.execute("EXPLAIN " + query)
+                for row in cursor.fetchall():
+                    print(row[0])
+            except psycopg.Error as e:
+                print(f"Query couldn't be explained: {e}")
+            conn.rollback()
+            print()
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply database migrations.")
+    parser.add_argument('--dry-run', action='store_true', help="print pending migrations without applying them")
+    parser.add_argument('--explain', action='store_true', help="print query plans of typical STATS queries")
+    parser.add_argument('--baseline', type=int, metavar='VERSION', help="mark migrations up to VERSION as applied without running them (databases migrated by hand)")
+    args = parser.parse_args()
+
+    migrations = load_migrations()
+    with psycopg.connect(conninfo) as conn:
+        applied = applied_versions(conn)
+        if args.baseline is not None:
+            with conn.transaction():
+                with conn.cursor() as cursor:
+                    for version, name, statements in migrations:
+                        if version<=args.baseline and version not in applied:
+                            record_version(cursor, version, name)
+                            print(f"Marked as applied: {name}")
+            return
+
+        pending = [migration for migration in migrations if migration[0] not in applied]
+        if not pending:
+            print("Database is up to date.")
+        for version, name, statements in pending:
+            mode = "statement by statement" if is_concurrent(statements) else "in one transaction"
+            if args.dry_run:
+                print(f"-- {name} (would run {mode})")
+                for statement in statements:
+                    print(statement.strip())
+                print()
+                continue
+            print(f"Applying {name} ({mode})...")
+            apply(conn, version, name, statements)
+        if args.explain:
+            explain(conn)
+
+if __name__ == '__main__':
+    main()
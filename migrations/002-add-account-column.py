@@ -0,0 +1,15 @@
+#run with migrate.py; "timezone" is the user's IANA time zone
+def statements(timezone):
+    result = []
+    #history of multiple accounts in one table, existing records belong to account 'default'
+    query="""
+        ALTER TABLE history
+        ADD COLUMN account text NOT NULL DEFAULT 'default';
+    """
+    result.append(query)
+    #the worker looks up the last record of every account
+    query="""
+        CREATE INDEX history_account_played_at_idx ON history (account, played_at DESC);
+    """
+    result.append(query)
+    return result
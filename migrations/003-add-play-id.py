@@ -0,0 +1,15 @@
+#run with migrate.py; "timezone" is the user's IANA time zone
+def statements(timezone):
+    result = []
+    #every play gets an ID generated by the worker, copying a play from the spool twice updates the same record
+    #existing records get a random ID (gen_random_uuid() requires PostgreSQL 13+)
+    query="""
+        ALTER TABLE history
+        ADD COLUMN play_id uuid NOT NULL DEFAULT gen_random_uuid();
+    """
+    result.append(query)
+    query="""
+        CREATE UNIQUE INDEX history_play_id_idx ON history (play_id);
+    """
+    result.append(query)
+    return result
@@ -0,0 +1,16 @@
+#run with migrate.py; "timezone" is the user's IANA time zone
+def statements(timezone):
+    result = []
+    #repeats of the same error are stored as one record with a count and the time of the first and last occurrence
+    query="""
+        ALTER TABLE error_log
+        ADD COLUMN count int4 NOT NULL DEFAULT 1,
+        ADD COLUMN first_seen timestamptz,
+        ADD COLUMN last_seen timestamptz;
+    """
+    result.append(query)
+    query="""
+        UPDATE error_log SET first_seen = date, last_seen = date;
+    """
+    result.append(query)
+    return result
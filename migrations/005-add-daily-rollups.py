@@ -0,0 +1,70 @@
+#run with migrate.py; "timezone" is the user's IANA time zone
+def statements(timezone):
+    result = []
+    #daily totals per track and per artist; "day" is the local day in the user's time zone
+    #streams = records with progress >= 45000, ms = summed progress
+    query="""
+        CREATE TABLE daily_track_stats (
+            day date NOT NULL,
+            artist1 text,
+            artist2 text,
+            artist3 text,
+            track_name text,
+            streams int8 NOT NULL DEFAULT 0,
+            ms int8 NOT NULL DEFAULT 0
+        );
+        CREATE UNIQUE INDEX daily_track_stats_key ON daily_track_stats
+            (day, COALESCE(artist1, ''), COALESCE(artist2, ''), COALESCE(artist3, ''), COALESCE(track_name, ''));
+
+        CREATE TABLE daily_artist_stats (
+            day date NOT NULL,
+            artist text NOT NULL,
+            streams int8 NOT NULL DEFAULT 0,
+            ms int8 NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, artist)
+        );
+    """
+    result.append(query)
+
+    #add a record's contribution ("sign" = 1) or remove it ("sign" = -1)
+    query=f"""
+        CREATE FUNCTION rollup_add(h history, sign int) RETURNS void AS $$
+        DECLARE
+            rollup_day date := (h.played_at AT TIME ZONE '{timezone}')::date;
+            rollup_streams int8 := sign * (CASE WHEN h.progress >= 45000 THEN 1 ELSE 0 END);
+            rollup_ms int8 := sign * COALESCE(h.progress, 0);
+            rollup_artist text;
+        BEGIN
+            INSERT INTO daily_track_stats AS s (day, artist1, artist2, artist3, track_name, streams, ms)
+            VALUES (rollup_day, h.artist1, h.artist2, h.artist3, h.track_name, rollup_streams, rollup_ms)
+            ON CONFLICT (day, COALESCE(artist1, ''), COALESCE(artist2, ''), COALESCE(artist3, ''), COALESCE(track_name, ''))
+            DO UPDATE SET streams = s.streams + EXCLUDED.streams, ms = s.ms + EXCLUDED.ms;
+
+            FOREACH rollup_artist IN ARRAY ARRAY[h.artist1, h.artist2, h.artist3] LOOP
+                CONTINUE WHEN rollup_artist IS NULL;
+                INSERT INTO daily_artist_stats AS s (day, artist, streams, ms)
+                VALUES (rollup_day, rollup_artist, rollup_streams, rollup_ms)
+                ON CONFLICT (day, artist)
+                DO UPDATE SET streams = s.streams + EXCLUDED.streams, ms = s.ms + EXCLUDED.ms;
+            END LOOP;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE FUNCTION history_rollup() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM rollup_add(OLD, -1);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM rollup_add(NEW, 1);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER history_rollup
+        AFTER INSERT OR DELETE OR UPDATE OF played_at, artist1, artist2, artist3, track_name, progress ON history
+        FOR EACH ROW EXECUTE FUNCTION history_rollup();
+    """
+    result.append(query)
+    return result
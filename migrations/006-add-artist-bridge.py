@@ -0,0 +1,124 @@
+#run with migrate.py; "timezone" is the user's IANA time zone
+def statements(timezone):
+    result = []
+    #writes to "history" wait until the bridge is filled and the rollup triggers are replaced
+    result.append("LOCK TABLE history IN SHARE MODE;")
+
+    #all artists of a track (no limit of 3), "position" is the artist's position on the track starting from 1
+    query="""
+        CREATE TABLE artists (
+            id bigserial PRIMARY KEY,
+            name text NOT NULL UNIQUE
+        );
+        CREATE TABLE history_artists (
+            history_id int8 NOT NULL REFERENCES history (id) ON DELETE CASCADE,
+            artist_id int8 NOT NULL REFERENCES artists (id),
+            position int2 NOT NULL,
+            PRIMARY KEY (history_id, position)
+        );
+        CREATE INDEX history_artists_artist_idx ON history_artists (artist_id, history_id);
+    """
+    result.append(query)
+
+    #existing records
+    query="""
+        INSERT INTO artists (name)
+        SELECT DISTINCT artist FROM (
+            SELECT artist1 as artist FROM history
+            UNION ALL
+            SELECT artist2 FROM history
+            UNION ALL
+            SELECT artist3 FROM history
+        ) as temp
+        WHERE artist IS NOT NULL
+        ON CONFLICT (name) DO NOTHING;
+
+        INSERT INTO history_artists (history_id, artist_id, position)
+        SELECT h.id, a.id, v.position
+        FROM history h
+        CROSS JOIN LATERAL (VALUES (1, h.artist1), (2, h.artist2), (3, h.artist3)) as v(position, name)
+        JOIN artists a ON a.name = v.name;
+    """
+    result.append(query)
+
+    #artist rollups are now maintained through "history_artists":
+    #a new bridge record adds the play to the artist, changes of the play are applied to all of its artists
+    query=f"""
+        CREATE OR REPLACE FUNCTION rollup_add(h history, sign int) RETURNS void AS $$
+        DECLARE
+            rollup_day date := (h.played_at AT TIME ZONE '{timezone}')::date;
+            rollup_streams int8 := sign * (CASE WHEN h.progress >= 45000 THEN 1 ELSE 0 END);
+            rollup_ms int8 := sign * COALESCE(h.progress, 0);
+        BEGIN
+            INSERT INTO daily_track_stats AS s (day, artist1, artist2, artist3, track_name, streams, ms)
+            VALUES (rollup_day, h.artist1, h.artist2, h.artist3, h.track_name, rollup_streams, rollup_ms)
+            ON CONFLICT (day, COALESCE(artist1, ''), COALESCE(artist2, ''), COALESCE(artist3, ''), COALESCE(track_name, ''))
+            DO UPDATE SET streams = s.streams + EXCLUDED.streams, ms = s.ms + EXCLUDED.ms;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE FUNCTION rollup_add_artist(h history, artist text, sign int) RETURNS void AS $$
+        BEGIN
+            INSERT INTO daily_artist_stats AS s (day, artist, streams, ms)
+            VALUES ((h.played_at AT TIME ZONE '{timezone}')::date, artist,
+                sign * (CASE WHEN h.progress >= 45000 THEN 1 ELSE 0 END), sign * COALESCE(h.progress, 0))
+            ON CONFLICT (day, artist)
+            DO UPDATE SET streams = s.streams + EXCLUDED.streams, ms = s.ms + EXCLUDED.ms;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION history_rollup() RETURNS trigger AS $$
+        DECLARE
+            rollup_artist text;
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM rollup_add(OLD, -1);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM rollup_add(NEW, 1);
+            END IF;
+            IF TG_OP = 'UPDATE' THEN
+                FOR rollup_artist IN
+                    SELECT a.name FROM history_artists ha JOIN artists a ON a.id = ha.artist_id WHERE ha.history_id = NEW.id
+                LOOP
+                    PERFORM rollup_add_artist(OLD, rollup_artist, -1);
+                    PERFORM rollup_add_artist(NEW, rollup_artist, 1);
+                END LOOP;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        --bridge records are removed with the play (ON DELETE CASCADE), so a deleted play is removed from its artists before
+        CREATE FUNCTION history_rollup_delete() RETURNS trigger AS $$
+        DECLARE
+            rollup_artist text;
+        BEGIN
+            FOR rollup_artist IN
+                SELECT a.name FROM history_artists ha JOIN artists a ON a.id = ha.artist_id WHERE ha.history_id = OLD.id
+            LOOP
+                PERFORM rollup_add_artist(OLD, rollup_artist, -1);
+            END LOOP;
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER history_rollup_delete
+        BEFORE DELETE ON history
+        FOR EACH ROW EXECUTE FUNCTION history_rollup_delete();
+
+        CREATE FUNCTION history_artists_rollup() RETURNS trigger AS $$
+        BEGIN
+            PERFORM rollup_add_artist(h, a.name, 1)
+            FROM history h, artists a
+            WHERE h.id = NEW.history_id AND a.id = NEW.artist_id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER history_artists_rollup
+        AFTER INSERT ON history_artists
+        FOR EACH ROW EXECUTE FUNCTION history_artists_rollup();
+    """
+    result.append(query)
+    return result
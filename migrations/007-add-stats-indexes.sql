@@ -0,0 +1,15 @@
+-- indexes for the STATS queries, built without blocking the worker's writes
+-- date ranges (played_at) and the worker's lookup of the last record
+CREATE INDEX CONCURRENTLY IF NOT EXISTS history_played_at_idx ON history (played_at);
+
+-- track name prefix lookups (track_name LIKE 'prefix%')
+CREATE INDEX CONCURRENTLY IF NOT EXISTS history_track_name_pattern_idx ON history (track_name text_pattern_ops);
+
+-- streams (progress >= 45000) in a date range, covering the columns the stream statistics group by
+CREATE INDEX CONCURRENTLY IF NOT EXISTS history_streams_idx ON history (played_at)
+    INCLUDE (artist1, artist2, artist3, track_name)
+    WHERE progress >= 45000;
+
+-- artist lookups go through history_artists (history_artists_artist_idx and the unique index on artists.name)
+-- rollups of an artist across all days
+CREATE INDEX CONCURRENTLY IF NOT EXISTS daily_artist_stats_artist_idx ON daily_artist_stats (artist, day);
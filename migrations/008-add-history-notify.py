@@ -0,0 +1,41 @@
+#run with migrate.py; "timezone" is the user's IANA time zone
+def statements(timezone):
+    result = []
+    #notify listeners (STATS result cache) about changes of "history", once per statement;
+    #the payload is the earliest played_at of the changed records (unix time)
+    query="""
+        CREATE FUNCTION history_notify() RETURNS trigger AS $$
+        DECLARE
+            since timestamptz;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                SELECT min(played_at) INTO since FROM new_rows;
+            ELSIF TG_OP = 'UPDATE' THEN
+                SELECT least((SELECT min(played_at) FROM new_rows), (SELECT min(played_at) FROM old_rows)) INTO since;
+            ELSE
+                SELECT min(played_at) INTO since FROM old_rows;
+            END IF;
+            IF since IS NOT NULL THEN
+                PERFORM pg_notify('history_changed', extract(epoch FROM since)::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER history_notify_insert
+        AFTER INSERT ON history
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION history_notify();
+
+        CREATE TRIGGER history_notify_update
+        AFTER UPDATE ON history
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION history_notify();
+
+        CREATE TRIGGER history_notify_delete
+        AFTER DELETE ON history
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION history_notify();
+    """
+    result.append(query)
+    return result
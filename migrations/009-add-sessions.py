@@ -0,0 +1,22 @@
+#run with migrate.py; "timezone" is the user's IANA time zone
+def statements(timezone):
+    result = []
+    #listening sessions, maintained by the worker (a pause longer than SESSION_GAP seconds starts a new session);
+    #sessions of existing history are added by "python backfill.py sessions"
+    query="""
+        CREATE TABLE sessions (
+            session_id uuid PRIMARY KEY,
+            account text NOT NULL DEFAULT 'default',
+            started_at timestamptz NOT NULL,
+            ended_at timestamptz NOT NULL,
+            tracks int4 NOT NULL,
+            ms int8 NOT NULL
+        );
+    """
+    result.append(query)
+    query="""
+        CREATE INDEX sessions_started_at_idx ON sessions (started_at) INCLUDE (ended_at, tracks, ms);
+        CREATE INDEX sessions_account_started_at_idx ON sessions (account, started_at DESC);
+    """
+    result.append(query)
+    return result
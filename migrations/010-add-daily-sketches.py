@@ -0,0 +1,18 @@
+#run with migrate.py; "timezone" is the user's IANA time zone
+def statements(timezone):
+    result = []
+    #sketches of the daily rollups per day and kind ('tracks' or 'artists', see sketches.py):
+    #Space-Saving summaries of streams and ms, and a HyperLogLog of the distinct items of the day;
+    #maintained by the worker, sketches of existing history are added by "python backfill.py sketches"
+    query="""
+        CREATE TABLE daily_sketches (
+            day date NOT NULL,
+            kind text NOT NULL,
+            streams jsonb NOT NULL,
+            ms jsonb NOT NULL,
+            distinct_items bytea NOT NULL,
+            PRIMARY KEY (day, kind)
+        );
+    """
+    result.append(query)
+    return result
@@ -0,0 +1,50 @@
+#run with migrate.py; "timezone" is the user's IANA time zone
+def statements(timezone):
+    result = []
+    #rollups and sketches per account, so statistics of one account (STATS "account" parameter) don't mix accounts;
+    #existing rows hold all accounts and are assigned to 'default' until "python backfill.py rollups" rebuilds them
+    query="""
+        ALTER TABLE daily_track_stats ADD COLUMN account text NOT NULL DEFAULT 'default';
+        DROP INDEX daily_track_stats_key;
+        CREATE UNIQUE INDEX daily_track_stats_key ON daily_track_stats
+            (day, account, COALESCE(artist1, ''), COALESCE(artist2, ''), COALESCE(artist3, ''), COALESCE(track_name, ''));
+
+        ALTER TABLE daily_artist_stats ADD COLUMN account text NOT NULL DEFAULT 'default';
+        ALTER TABLE daily_artist_stats DROP CONSTRAINT daily_artist_stats_pkey, ADD PRIMARY KEY (day, account, artist);
+
+        ALTER TABLE daily_sketches ADD COLUMN account text NOT NULL DEFAULT 'default';
+        ALTER TABLE daily_sketches DROP CONSTRAINT daily_sketches_pkey, ADD PRIMARY KEY (day, kind, account);
+    """
+    result.append(query)
+
+    #the trigger function of migrations/005-add-daily-rollups.py, keyed by account
+    query=f"""
+        CREATE OR REPLACE FUNCTION rollup_add(h history, sign int) RETURNS void AS $$
+        DECLARE
+            rollup_day date := (h.played_at AT TIME ZONE '{timezone}')::date;
+            rollup_streams int8 := sign * (CASE WHEN h.progress >= 45000 THEN 1 ELSE 0 END);
+            rollup_ms int8 := sign * COALESCE(h.progress, 0);
+            rollup_artist text;
+        BEGIN
+            INSERT INTO daily_track_stats AS s (day, account, artist1, artist2, artist3, track_name, streams, ms)
+            VALUES (rollup_day, h.account, h.artist1, h.artist2, h.artist3, h.track_name, rollup_streams, rollup_ms)
+            ON CONFLICT (day, account, COALESCE(artist1, ''), COALESCE(artist2, ''), COALESCE(artist3, ''), COALESCE(track_name, ''))
+            DO UPDATE SET streams = s.streams + EXCLUDED.streams, ms = s.ms + EXCLUDED.ms;
+
+            FOREACH rollup_artist IN ARRAY ARRAY[h.artist1, h.artist2, h.artist3] LOOP
+                CONTINUE WHEN rollup_artist IS NULL;
+                INSERT INTO daily_artist_stats AS s (day, account, artist, streams, ms)
+                VALUES (rollup_day, h.account, rollup_artist, rollup_streams, rollup_ms)
+                ON CONFLICT (day, account, artist)
+                DO UPDATE SET streams = s.streams + EXCLUDED.streams, ms = s.ms + EXCLUDED.ms;
+            END LOOP;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER history_rollup ON history;
+        CREATE TRIGGER history_rollup
+        AFTER INSERT OR DELETE OR UPDATE OF account, played_at, artist1, artist2, artist3, track_name, progress ON history
+        FOR EACH ROW EXECUTE FUNCTION history_rollup();
+    """
+    result.append(query)
+    return result
@@ -0,0 +1,23 @@
+#run with migrate.py; "timezone" is the user's IANA time zone
+def statements(timezone):
+    result = []
+    #transaction that last wrote each record (insert or update), for the incremental export of snapshot.py:
+    #unlike ids (insert order), transactions below pg_snapshot_xmin() of a snapshot have all finished,
+    #so an export bounded by it doesn't skip records of transactions that commit later;
+    #existing records have NULL until they are updated (they are exported by the first run)
+    query="""
+        ALTER TABLE history ADD COLUMN written_xid xid8;
+
+        CREATE FUNCTION history_written() RETURNS trigger AS $$
+        BEGIN
+            NEW.written_xid := pg_current_xact_id();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER history_written
+        BEFORE INSERT OR UPDATE ON history
+        FOR EACH ROW EXECUTE FUNCTION history_written();
+    """
+    result.append(query)
+    return result
@@ -0,0 +1,2 @@
+-- records written since the last export of snapshot.py, built without blocking the worker's writes
+CREATE INDEX CONCURRENTLY IF NOT EXISTS history_written_xid_idx ON history (written_xid);
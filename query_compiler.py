@@ -0,0 +1,417 @@
+import base64
+import datetime as d
+import json
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from psycopg.types.numeric import Int8
+
+#maps STATS requests to a small set of canonical query "shapes"
+#the SQL of every shape is fixed (only the parameters change), so each shape is planned once per pooled connection
+#and then executed as a prepared statement; unused parts of a shape get NULL bounds, which match no records
+
+class RequestError(ValueError):
+    pass
+
+#records of an artist (any position on the track), an index lookup in "history_artists"
+ARTIST_FILTER = "id IN (SELECT ha.history_id FROM history_artists ha JOIN artists a ON a.id = ha.artist_id WHERE {condition})"
+
+#grouping keys of the shapes, in sort order (tracks have up to 3 artists, missing ones sort as '', as in page tokens)
+TRACK_KEYS = ["COALESCE(artist1, '')", "COALESCE(artist2, '')", "COALESCE(artist3, '')", "track_name"]
+
+#keyset pagination: rows after the last row of the previous page (ordered by value DESC, keys ASC);
+#NULL "after_value" - first page
+def keyset(value, keys):
+    after = ", ".join(f"%(after{i})s::text" for i in range(len(keys)))
+    return f"(%(after_value)s::int8 IS NULL OR {value} < %(after_value)s OR ({value} = %(after_value)s AND ({', '.join(keys)}) > ({after})))"
+
+#optional date range of a "history" query (NULL - unbounded)
+RANGE_FILTER = "played_at >= COALESCE(%(start)s::timestamptz, '-infinity') AND played_at <= COALESCE(%(end)s::timestamptz, 'infinity')"
+
+#optional account of every shape (NULL - all accounts); "history", the rollups, the sketches and "sessions" have an "account" column
+ACCOUNT_FILTER = "(%(account)s::text IS NULL OR account = %(account)s)"
+
+#---------------------------------------------DAILY ROLLUPS
+#whole days of the interval are read from the daily rollups (daily_track_stats, daily_artist_stats),
+#only the partial days at the edges ("head" and "tail") are read from "history"
+def rollup_source(kind):
+    if kind=="artists":
+        rollup = "SELECT artist, streams, ms FROM daily_artist_stats"
+        raw = """SELECT artist, (progress>=45000)::int as streams, progress as ms FROM (
+                SELECT h.account, h.played_at, a.name as artist, h.progress FROM history h
+                JOIN history_artists ha ON ha.history_id = h.id
+                JOIN artists a ON a.id = ha.artist_id
+            ) as temp"""
+    else:
+        rollup = "SELECT artist1, artist2, artist3, track_name, streams, ms FROM daily_track_stats"
+        raw = "SELECT artist1, artist2, artist3, track_name, (progress>=45000)::int as streams, progress as ms FROM history"
+    parts = [
+        rollup + " WHERE day >= COALESCE(%(first_day)s::date, '-infinity') AND day <= COALESCE(%(last_day)s::date, 'infinity')",
+        raw + " WHERE played_at >= %(head_start)s AND played_at < %(head_end)s",
+        raw + " WHERE played_at >= %(tail_start)s AND played_at <= %(tail_end)s"
+    ]
+    parts = [part + " AND " + ACCOUNT_FILTER for part in parts]
+    return "\nUNION ALL\n".join(parts)
+
+#top artists/tracks by streams or duration (measure: 'streams' or 'ms')
+def rollup_query(measure, kind):
+    if kind=="artists":
+        group_part = "artist"
+        keys = ["artist"]
+    else:
+        group_part = "artist1, artist2, artist3, track_name"
+        keys = TRACK_KEYS
+    if measure=="streams":
+        value = "SUM(streams)::int8"
+        having = [f"{value} > 0"]
+    else:
+        value = "SUM(ms)::int8"
+        having = []
+    having.append(keyset(value, keys))
+    return f"SELECT {value} as {measure}, {group_part}\nFROM ({rollup_source(kind)}) as src\nGROUP BY {group_part}\nHAVING " + " AND ".join(having) + f"\nORDER BY {measure} DESC, {', '.join(keys)}\nLIMIT %(limit)s"
+
+#statistics of "history" records filtered by artist (top tracks of an artist or a specific track)
+def history_query(measure, track):
+    if measure=="streams":
+        value = "COUNT(*)"
+        where_part = ["progress>=45000"]
+    else:
+        value = "SUM(progress)::int8"
+        where_part = []
+    if track:
+        select_part = "artist1, artist2, artist3, track_name"
+        keys = TRACK_KEYS
+        where_part.append(ARTIST_FILTER.format(condition="a.name = ANY(%(artists)s::text[])"))
+        where_part.append("track_name LIKE %(prefix)s")
+    else:
+        select_part = "track_name"
+        keys = ["track_name"]
+        where_part.append(ARTIST_FILTER.format(condition="a.name = %(artist)s"))
+    where_part.append(RANGE_FILTER)
+    where_part.append(ACCOUNT_FILTER)
+    return f"SELECT {value} as {measure}, {select_part}\nFROM history\nWHERE " + " AND ".join(where_part) + f"\nGROUP BY {select_part}\nHAVING {keyset(value, keys)}\nORDER BY {measure} DESC, {', '.join(keys)}\nLIMIT %(limit)s"
+
+#streams and duration of every group and the total time of all groups (before the limit) in one pass
+def summary_query(source, group_part, keys, streams, ms, total=None):
+    if total is None:
+        total = f"(SUM({ms}) OVER ())::int8"
+    return f"SELECT {streams} as streams, {ms} as ms, {group_part}, {total} as total_ms\nFROM {source}\nGROUP BY {group_part}\nORDER BY streams DESC, {', '.join(keys)}\nLIMIT %(limit)s"
+
+def summary_rollup_query(kind):
+    if kind=="artists":
+        #time of a track is attributed to each of its artists, so the total is taken from the track rollups
+        total = f"(SELECT SUM(ms)::int8 FROM ({rollup_source('tracks')}) as tracks)"
+        return summary_query(f"({rollup_source(kind)}) as src", "artist", ["artist"], "SUM(streams)::int8", "SUM(ms)::int8", total)
+    return summary_query(f"({rollup_source(kind)}) as src", "artist1, artist2, artist3, track_name", TRACK_KEYS, "SUM(streams)::int8", "SUM(ms)::int8")
+
+#streams are counted with a FILTER, so the records are read only once
+def summary_history_query(track):
+    if track:
+        group_part = "artist1, artist2, artist3, track_name"
+        keys = TRACK_KEYS
+        where_part = [ARTIST_FILTER.format(condition="a.name = ANY(%(artists)s::text[])"), "track_name LIKE %(prefix)s"]
+    else:
+        group_part = "track_name"
+        keys = ["track_name"]
+        where_part = [ARTIST_FILTER.format(condition="a.name = %(artist)s")]
+    where_part.append(RANGE_FILTER)
+    where_part.append(ACCOUNT_FILTER)
+    source = "history\nWHERE " + " AND ".join(where_part)
+    return summary_query(source, group_part, keys, "COUNT(*) FILTER (WHERE progress>=45000)", "SUM(progress)::int8")
+
+#---------------------------------------------TIMELINE
+#streams and duration per time bucket (local time of the user's time zone), empty buckets included;
+#"bucket" is the date_trunc field (hour, day, week, month), "step" the interval between buckets
+def timeline_query(source):
+    return f"""WITH data AS (
+    SELECT date_trunc(%(bucket)s, at) as bucket, SUM(streams)::int8 as streams, SUM(ms)::int8 as ms
+    FROM ({source}) as src
+    GROUP BY 1
+), buckets AS (
+    SELECT generate_series(
+        COALESCE(date_trunc(%(bucket)s, %(start)s::timestamptz AT TIME ZONE %(tz)s), (SELECT min(bucket) FROM data)),
+        COALESCE(date_trunc(%(bucket)s, %(end)s::timestamptz AT TIME ZONE %(tz)s), (SELECT max(bucket) FROM data)),
+        %(step)s::interval
+    ) as bucket
+)
+SELECT b.bucket, COALESCE(data.streams, 0) as streams, COALESCE(data.ms, 0) as ms
+FROM buckets b
+LEFT JOIN data ON data.bucket = b.bucket
+ORDER BY b.bucket"""
+
+#largest number of buckets of a timeline response; the shortest length of each bucket is used to estimate the count
+#(an open-ended start is not checked for daily and longer buckets: 10 000 days are more than any streaming history)
+MAX_BUCKETS = 10000
+BUCKET_LENGTH = {"hour": d.timedelta(hours=1), "day": d.timedelta(days=1), "week": d.timedelta(weeks=1), "month": d.timedelta(days=28)}
+
+TIMELINE_RAW = "SELECT played_at AT TIME ZONE %(tz)s as at, (progress>=45000)::int as streams, progress as ms FROM history"
+
+#whole days from "daily_track_stats" (not for hourly buckets), partial days at the edges from "history"
+def timeline_rollup_source():
+    parts = [
+        "SELECT day::timestamp as at, streams, ms FROM daily_track_stats WHERE day >= COALESCE(%(first_day)s::date, '-infinity') AND day <= COALESCE(%(last_day)s::date, 'infinity')",
+        TIMELINE_RAW + " WHERE played_at >= %(head_start)s AND played_at < %(head_end)s",
+        TIMELINE_RAW + " WHERE played_at >= %(tail_start)s AND played_at <= %(tail_end)s"
+    ]
+    parts = [part + " AND " + ACCOUNT_FILTER for part in parts]
+    return "\nUNION ALL\n".join(parts)
+
+def timeline_history_source(condition=None):
+    where_part = [RANGE_FILTER, ACCOUNT_FILTER]
+    if condition:
+        where_part.insert(0, ARTIST_FILTER.format(condition=condition))
+    return TIMELINE_RAW + " WHERE " + " AND ".join(where_part)
+
+#whole days of the interval, including the partial first and last days
+APPROX_DAYS = "day >= COALESCE(%(first_day)s::date, '-infinity') AND day <= COALESCE(%(last_day)s::date, 'infinity') AND " + ACCOUNT_FILTER
+
+SHAPES = {
+    "streams.top_tracks": rollup_query("streams", "tracks"),
+    "streams.top_artists": rollup_query("streams", "artists"),
+    "streams.artist_tracks": history_query("streams", False),
+    "streams.track": history_query("streams", True),
+    "duration.top_tracks": rollup_query("ms", "tracks"),
+    "duration.top_artists": rollup_query("ms", "artists"),
+    "duration.artist_tracks": history_query("ms", False),
+    "duration.track": history_query("ms", True),
+    "summary.top_tracks": summary_rollup_query("tracks"),
+    "summary.top_artists": summary_rollup_query("artists"),
+    "summary.artist_tracks": summary_history_query(False),
+    "summary.track": summary_history_query(True),
+    "timeline.rollup": timeline_query(timeline_rollup_source()),
+    "timeline.all": timeline_query(timeline_history_source()),
+    "timeline.artist": timeline_query(timeline_history_source("a.name = %(artist)s")),
+    "timeline.track": timeline_query(timeline_history_source("a.name = ANY(%(artists)s::text[])") + " AND track_name LIKE %(prefix)s"),
+    #sketches of the requested days and accounts (see sketches.py), merged by stats_format.build_approx
+    "streams.approx": "SELECT streams, distinct_items\nFROM daily_sketches\nWHERE kind = %(kind)s AND " + APPROX_DAYS,
+    "duration.approx": "SELECT ms, distinct_items\nFROM daily_sketches\nWHERE kind = %(kind)s AND " + APPROX_DAYS,
+    "sessions": """SELECT COUNT(*) as sessions, AVG(EXTRACT(EPOCH FROM ended_at - started_at) * 1000)::int8 as length_ms,
+    AVG(tracks)::float8 as tracks, SUM(ms)::int8 as ms
+FROM sessions
+WHERE started_at >= COALESCE(%(start)s::timestamptz, '-infinity') AND started_at <= COALESCE(%(end)s::timestamptz, 'infinity') AND """ + ACCOUNT_FILTER,
+    "total": f"SELECT SUM(ms)::int8 as ms\nFROM ({rollup_source('tracks')}) as src",
+    "total.artist": "SELECT SUM(progress) as ms\nFROM history\nWHERE " + ARTIST_FILTER.format(condition="a.name like %(artist)s") + " AND " + RANGE_FILTER + " AND " + ACCOUNT_FILTER
+}
+
+#columns of the pagination keys of a row, per shape
+def shape_keys(shape):
+    if shape.endswith(".top_artists"):
+        return ["artist"]
+    if shape.endswith(".artist_tracks"):
+        return ["track_name"]
+    return ["artist1", "artist2", "artist3", "track_name"]
+
+#works with sync and async cursors (returns the awaitable of an async cursor)
+def execute(cursor, shape, params):
+    return cursor.execute(SHAPES[shape], params, prepare=True)
+
+#token of the page following "row" (the last row of a page), passed back as the "after" parameter
+def page_token(shape, row):
+    value = row["streams"] if "streams" in row else row["ms"]
+    keys = [row[column] or '' for column in shape_keys(shape)]
+    token = json.dumps([shape, value] + keys, separators=(",", ":"))
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip("=")
+
+def read_token(token):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        shape, value, keys = data[0], int(data[1]), [str(key) for key in data[2:]]
+    except (ValueError, TypeError, IndexError):
+        raise RequestError("Invalid page token.")
+    return shape, value, keys
+
+class QueryCompiler:
+    def __init__(self, timezone):
+        self.timezone = timezone
+
+    def format_date(self, date, date_type='start'):
+        if date is None:
+            return None
+        if isinstance(date, str):
+            #convert date to ISO format
+            date = date.replace(" ", "-").replace("/", "-")
+            try:
+                date = datetime.fromisoformat(date)
+            except ValueError:
+                raise RequestError(f"Invalid date: {date}.")
+
+        #format end date to make date interval inclusive
+        if date_type=='end' and date.hour==0 and date.minute==0:
+            date = date.replace(hour=23, minute=59, second=59, microsecond=999999)
+        #add timezone
+        datetz = date.replace(tzinfo=ZoneInfo(self.timezone))
+        return datetz
+
+    def midnight(self, day):
+        return datetime.combine(day, d.time(0), tzinfo=ZoneInfo(self.timezone))
+
+    #validated request parameters; endpoint: 'streams', 'duration', 'summary', 'timeline', 'sessions' or 'total'
+    def parse(self, endpoint, args):
+        artists = args.getlist('artist')
+        name = args.get('track')
+        start = args.get('startDate')
+        end = args.get('endDate')
+        limit = args.get('limit', 20)
+        analysis_type = args.get('type')
+        after = args.get('after')
+        bucket = args.get('bucket', 'day')
+        approx = args.get('approx')
+        account = args.get('account') or None #all accounts
+
+        if endpoint=="total":
+            if len(artists)>1:
+                raise RequestError("Too many artists entered. Only one artist is allowed.")
+            name = analysis_type = after = approx = None
+            limit = None
+        elif endpoint=="sessions": #only the date range is used
+            artists = []
+            name = analysis_type = after = approx = None
+            limit = None
+        elif endpoint=="timeline":
+            if bucket not in ['hour', 'day', 'week', 'month']:
+                raise RequestError("Invalid bucket selected. Allowed buckets: 'hour', 'day', 'week', 'month'.")
+            if name and not artists: #name requires artist, as song names are not unique
+                raise RequestError("Missing data: enter at least one artist.")
+            if len(artists)>1 and not name: #when more than 1 artist is provided, statistics are for a specific track
+                raise RequestError("Missing data: enter a track name.")
+            analysis_type = after = approx = None
+            limit = None
+        else:
+            if len(args)<1: #a minimum of one parameter is required
+                raise RequestError("No parameters were selected.")
+            elif all(arg in ['limit', 'after', 'format', 'approx', 'account'] for arg in args): #"limit" cannot be the only one parameter
+                raise RequestError("Select additional parameters.")
+
+            #parameter checking
+            if name and not artists: #name requires artist, as song names are not unique
+                raise RequestError("Missing data: enter at least one artist.")
+
+            if len(artists)>1 and not name: #when more than 1 artist is provided, statistics are for a specific track
+                raise RequestError("Missing data: enter a track name.")
+
+            if artists and analysis_type: #type ignored when artists are provided
+                analysis_type = None
+
+            if analysis_type and analysis_type not in ['tracks', 'artists']: #general statistics can be either by tracks or artists
+                raise RequestError("Invalid type selected. Allowed types: 'artists', 'tracks'.")
+
+            if (start or end) and (not analysis_type and not artists): #interval cannot be the only parameter
+                raise RequestError("Select additional parameters.")
+
+            if approx not in [None, 'true', 'false']:
+                raise RequestError("Invalid approx value. Allowed values: 'true', 'false'.")
+            approx = approx=="true"
+            if approx and (endpoint=="summary" or not analysis_type): #sketches are kept for top artists and top tracks only
+                raise RequestError("Approximate statistics are only available for type=artists or type=tracks.")
+
+            try:
+                limit = int(limit)
+            except ValueError:
+                raise RequestError("Invalid limit: enter a whole number.")
+            if limit<=0: #no limit applied
+                limit = None
+            if after and endpoint!="summary": #all rows of a summary are on one page
+                after = read_token(after)
+            else:
+                after = None
+
+        start = self.format_date(start)
+        end = self.format_date(end, 'end')
+        if start is not None and end is not None and not end>start:
+            raise RequestError("The end date cannot be earlier than the start date.")
+        if endpoint=="timeline":
+            self.check_buckets(bucket, start, end)
+
+        return {"artists": artists, "name": name, "start": start, "end": end, "limit": limit, "type": analysis_type, "after": after, "bucket": bucket, "approx": approx, "account": account}
+
+    #rejects timelines with more than MAX_BUCKETS buckets (an open end is now); hourly buckets need a start date,
+    #as the series would otherwise start at the first play of the history
+    def check_buckets(self, bucket, start, end):
+        if start is None:
+            if bucket=="hour":
+                raise RequestError("Select a start date for hourly buckets.")
+            return
+        end = end if end is not None else datetime.now(ZoneInfo(self.timezone))
+        buckets = (end-start)//BUCKET_LENGTH[bucket] + 1
+        if buckets>MAX_BUCKETS:
+            raise RequestError(f"Too many buckets ({buckets}). Select a shorter date range or a longer bucket (at most {MAX_BUCKETS} buckets).")
+
+    #whole days of the interval and its partial first ("head") and last ("tail") days
+    def split_days(self, start, end):
+        first_day = last_day = None
+        if start is not None:
+            first_day = start.date() if start.time()==d.time(0) else start.date() + d.timedelta(days=1)
+        if end is not None:
+            last_day = end.date() if end.time()==d.time(23, 59, 59, 999999) else end.date() - d.timedelta(days=1)
+
+        head = tail = (None, None)
+        if first_day and last_day and first_day>last_day: #no whole day in the interval
+            tail = (start, end)
+        else:
+            if start is not None and start!=self.midnight(first_day):
+                head = (start, self.midnight(first_day))
+            if end is not None and last_day!=end.date():
+                tail = (self.midnight(last_day + d.timedelta(days=1)), end)
+        return {"first_day": first_day, "last_day": last_day,
+                "head_start": head[0], "head_end": head[1], "tail_start": tail[0], "tail_end": tail[1]}
+
+    #shape name and parameters of a parsed request; every shape is limited to the account (NULL - all accounts)
+    def bind(self, endpoint, req):
+        shape, params = self.bind_shape(endpoint, req)
+        params["account"] = req["account"]
+        return shape, params
+
+    def bind_shape(self, endpoint, req):
+        limit = Int8(req["limit"]) if req["limit"] is not None else None
+        artists = req["artists"]
+        if endpoint=="total":
+            if artists:
+                return "total.artist", {"artist": artists[0], "start": req["start"], "end": req["end"]}
+            return "total", self.split_days(req["start"], req["end"])
+
+        if endpoint=="sessions":
+            return "sessions", {"start": req["start"], "end": req["end"]}
+
+        if endpoint=="timeline":
+            params = {"bucket": req["bucket"], "step": f"1 {req['bucket']}", "tz": self.timezone, "start": req["start"], "end": req["end"]}
+            if req["name"]:
+                params["artists"] = sorted(set(artists))
+                params["prefix"] = req["name"] + '%'
+                return "timeline.track", params
+            if artists:
+                params["artist"] = artists[0]
+                return "timeline.artist", params
+            if req["bucket"]=="hour":
+                return "timeline.all", params
+            params.update(self.split_days(req["start"], req["end"]))
+            return "timeline.rollup", params
+
+        if req["approx"]:
+            return f"{endpoint}.approx", {"kind": req["type"], "limit": limit,
+                                          "first_day": req["start"].date() if req["start"] else None,
+                                          "last_day": req["end"].date() if req["end"] else None}
+
+        if req["type"]:
+            shape = f"{endpoint}.top_{req['type']}"
+            params = self.split_days(req["start"], req["end"])
+        elif req["name"]:
+            shape = f"{endpoint}.track"
+            params = {"start": req["start"], "end": req["end"], "artists": sorted(set(artists)), "prefix": req["name"] + '%'}
+        else:
+            shape = f"{endpoint}.artist_tracks"
+            params = {"start": req["start"], "end": req["end"], "artist": artists[0]}
+        params["limit"] = limit
+        if endpoint=="summary":
+            return shape, params
+
+        keys = shape_keys(shape)
+        params["after_value"] = None
+        for i in range(len(keys)):
+            params[f"after{i}"] = None
+        if req["after"]:
+            token_shape, value, after = req["after"]
+            if token_shape!=shape or len(after)!=len(keys):
+                raise RequestError("Invalid page token.")
+            params["after_value"] = Int8(value)
+            for i, key in enumerate(after):
+                params[f"after{i}"] = key
+        return shape, params
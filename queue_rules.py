@@ -0,0 +1,88 @@
+import json
+import os
+import time
+
+#custom queueing rules from queue.json, indexed by the Spotify ID of the current track
+#"nextTrack" can be a single ID or a list of IDs (queued in the given order);
+#rules are chained: if "nextTrack" has its own rule, its tracks are queued as well
+class QueueRules:
+    def __init__(self, path='queue.json', check_interval=10, max_chain=20):
+        self.path = path
+        self.check_interval = check_interval
+        self.max_chain = max_chain
+        self.mtime = None
+        self.checked = 0
+        self.index = {}
+
+    #rebuild the index if the file changed since it was loaded
+    def reload(self):
+        now = time.monotonic()
+        if self.mtime is not None and now-self.checked<self.check_interval:
+            return
+        self.checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = 0
+        if mtime==self.mtime:
+            return
+        try:
+            combos = []
+            if mtime!=0:
+                with open(self.path, 'r') as file:
+                    combos = json.load(file)
+            index = {}
+            for combo in combos:
+                next_tracks = combo['nextTrack']
+                if isinstance(next_tracks, str):
+                    next_tracks = [next_tracks]
+                index.setdefault(combo['currentTrack'], []).extend(next_tracks)
+        except (OSError, ValueError, KeyError, TypeError) as e: #keep the previous rules until the file is fixed
+            print(f"Queue rules couldn't be loaded: {e!r}\n")
+            self.mtime = mtime
+            return
+        self.index = index
+        self.mtime = mtime
+
+    def __len__(self):
+        return len(self.index)
+
+    #tracks to queue after "track_id", following chained rules; empty if there is no rule
+    def next_tracks(self, track_id):
+        self.reload()
+        tracks = []
+        pending = list(self.index.get(track_id, []))
+        seen = {track_id}
+        while pending and len(tracks)<self.max_chain:
+            track = pending.pop(0)
+            if track in seen: #a rule cycle
+                continue
+            seen.add(track)
+            tracks.append(track)
+            pending = self.index.get(track, []) + pending
+        return tracks
+
+#last known queue of the user, so that repeated rule matches do not request it again
+#the snapshot follows the queue when the next track starts playing and expires after "ttl" seconds
+class QueueSnapshot:
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.track = None
+        self.upcoming = []
+        self.time = 0
+
+    def get(self, track_id):
+        if time.monotonic()-self.time>self.ttl:
+            return None
+        if track_id==self.track:
+            return self.upcoming
+        if len(self.upcoming)>1 and self.upcoming[0]==track_id: #queue moved on to the next track
+            self.track = track_id
+            self.upcoming = self.upcoming[1:]
+            return self.upcoming
+        return None
+
+    def set(self, track_id, upcoming):
+        self.track = track_id
+        self.upcoming = upcoming
+        self.time = time.monotonic()
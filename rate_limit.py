@@ -0,0 +1,22 @@
+import asyncio
+import time
+
+#token bucket shared by all Spotify clients of the worker, caps the total request rate
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now-self.updated)*self.rate)
+                self.updated = now
+                if self.tokens>=1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1-self.tokens)/self.rate)
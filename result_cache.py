@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+import psycopg
+
+#LRU cache of STATS responses, invalidated when "history" changes
+#the database sends a notification (channel "history_changed") with the earliest played_at of the changed records,
+#so only entries whose date range ends at or after it are dropped; closed date ranges stay cached
+#the cache is used only while the notification listener is connected; stop() ends the listener thread
+class ResultCache:
+    def __init__(self, max_entries=256, channel="history_changed"):
+        self.max_entries = max_entries
+        self.channel = channel
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.listening = False
+        #incremented by every invalidation; a result is stored only if no invalidation happened since the
+        #generation was read (before the lookup and the query), otherwise it may hold data from before the change
+        self.generation = 0
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def get(self, key):
+        if not self.listening:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    #"end" is the end of the entry's date range (None if open-ended),
+    #"generation" the value of self.generation read before the result was queried
+    def put(self, key, value, end, generation):
+        if not self.listening:
+            return
+        with self.lock:
+            if generation!=self.generation:
+                return
+            self.entries[key] = (value, end)
+            self.entries.move_to_end(key)
+            while len(self.entries)>self.max_entries:
+                self.entries.popitem(last=False)
+
+    #drop entries that may include records played at or after "since" (all entries if None)
+    def invalidate(self, since=None):
+        with self.lock:
+            self.generation += 1
+            if since is None:
+                self.entries.clear()
+                return
+            for key, (value, end) in list(self.entries.items()):
+                if end is None or end>=since:
+                    del self.entries[key]
+
+    #notifications are read with a timeout, so a stop is noticed within "poll" seconds
+    def listen(self, conninfo, retry=5, poll=1.0):
+        while not self.stopping.is_set():
+            try:
+                with psycopg.connect(conninfo, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {self.channel};")
+                    #changes made while not listening are unknown
+                    self.invalidate()
+                    self.listening = True
+                    while not self.stopping.is_set():
+                        for notify in conn.notifies(timeout=poll):
+                            try:
+                                since = datetime.fromtimestamp(float(notify.payload), timezone.utc)
+                            except ValueError:
+                                since = None
+                            self.invalidate(since)
+            except Exception as e:
+                print(f"Result cache listener disconnected: {e}")
+            self.listening = False
+            self.invalidate()
+            self.stopping.wait(retry)
+
+    def start(self, conninfo):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.listen, args=(conninfo,), daemon=True)
+        self.thread.start()
+        return self.thread
+
+    #stops the listener (and closes its connection); the cache is not used afterwards
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
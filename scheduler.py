@@ -0,0 +1,91 @@
+import time
+from collections import deque
+
+#decides when to poll the playback state next
+#while a track is playing, requests are sent around the moments that matter for logging:
+#after the 45s stream threshold and within the last 6s of the track (see the "<6s remaining" correction in HistoryCache),
+#and sparsely in between (so a skip between those moments is seen up to "sparse" seconds late);
+#after any change of the state (another track, paused, resumed, inactive) the next request is sent after "dense"
+#seconds; long pauses and inactivity back off exponentially up to "max_idle" (by default close to the fixed
+#30s/60s of polling without a schedule, so a resumed session is seen as quickly), errors up to "max_error"
+class PollScheduler:
+    def __init__(self, dense=5, sparse=30, paused=30, inactive=60, error=15, max_idle=60, max_error=300,
+                 stream_threshold=45000, end_margin=6000):
+        self.dense = dense
+        self.sparse = sparse
+        self.paused_delay = paused
+        self.inactive_delay = inactive
+        self.error_delay = error
+        self.max_idle = max_idle
+        self.max_error = max_error
+        self.stream_threshold = stream_threshold
+        self.end_margin = end_margin
+        self.idle_streak = 0
+        self.error_streak = 0
+        #last known playback state: ("playing", track), ("paused",) or ("inactive",)
+        self.state = None
+        self.polls = deque()
+
+    #record a request to Spotify, used for the polls per hour metric
+    def poll(self):
+        now = time.monotonic()
+        self.polls.append(now)
+        while self.polls and now-self.polls[0]>3600:
+            self.polls.popleft()
+
+    def polls_per_hour(self):
+        now = time.monotonic()
+        while self.polls and now-self.polls[0]>3600:
+            self.polls.popleft()
+        return len(self.polls)
+
+    #true if the playback state differs from the one of the previous request
+    def changed(self, state):
+        changed = self.state is not None and state!=self.state
+        self.state = state
+        return changed
+
+    #delay (in seconds) while a track is playing; "track" identifies the track (ID or name)
+    def playing(self, progress, duration, track=None):
+        self.idle_streak = 0
+        self.error_streak = 0
+        changed = self.changed(("playing", track))
+        remaining = duration - progress
+        if remaining<=self.end_margin: #track is about to end, catch the next one
+            return max(1, min(self.dense, remaining/1000 + 1))
+        #moments worth a request: right after the stream threshold and in the middle of the last 6s
+        moments = [self.stream_threshold + 1000, duration - self.end_margin/2]
+        upcoming = [(moment - progress)/1000 for moment in moments if moment>progress]
+        delay = min(upcoming + [self.sparse] + ([self.dense] if changed else []))
+        return max(1, delay)
+
+    def backoff(self, delay, streak, limit):
+        return min(limit, delay * 2**streak)
+
+    #delay while playback is paused
+    def paused(self):
+        self.error_streak = 0
+        if self.changed(("paused",)):
+            self.idle_streak = 0
+            return self.dense
+        delay = self.backoff(self.paused_delay, self.idle_streak, max(self.max_idle, self.paused_delay))
+        self.idle_streak += 1
+        return delay
+
+    #delay while playback is not available or active
+    def inactive(self):
+        self.error_streak = 0
+        if self.changed(("inactive",)):
+            self.idle_streak = 0
+            return self.dense
+        delay = self.backoff(self.inactive_delay, self.idle_streak, max(self.max_idle, self.inactive_delay))
+        self.idle_streak += 1
+        return delay
+
+    #delay after an error; "retry_after" (in seconds) is respected when Spotify sends it
+    def error(self, retry_after=None):
+        delay = self.backoff(self.error_delay, self.error_streak, self.max_error)
+        self.error_streak += 1
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import math
+import struct
+
+#mergeable sketches of the daily rollups (daily_track_stats, daily_artist_stats), kept per day in "daily_sketches"
+#(see migrations/010-add-daily-sketches.py), per account since migrations/011-add-account-to-rollups.py;
+#approximate STATS answers (approx=true) merge the sketches of the requested days (and accounts) instead of grouping
+#all rollup rows of the range
+
+#heavy hitters: at most "capacity" items with their counts, in the form of a Space-Saving summary;
+#"count" of an item is an upper bound of its true count and "count - error" a lower bound,
+#an item that is not kept has a true count of at most "floor"
+class SpaceSaving:
+    def __init__(self, capacity, counters=None, floor=0):
+        self.capacity = capacity
+        self.counters = counters or {} #item: [count, error]
+        self.floor = floor
+
+    #exact counts of one day: the largest "capacity" of them are kept, with no error
+    @classmethod
+    def from_counts(cls, capacity, counts):
+        items = sorted(counts.items(), key=lambda item: -item[1])
+        floor = items[capacity][1] if len(items)>capacity else 0
+        return cls(capacity, {item: [count, 0] for item, count in items[:capacity]}, floor)
+
+    #summary of the sum of the counts of all summaries: an item missing from a summary may have
+    #a count of up to that summary's floor there, which is added to both its count and its error
+    @classmethod
+    def merged(cls, capacity, summaries):
+        counters = {}
+        floors = 0
+        for summary in summaries:
+            floors += summary.floor
+            for item, (count, error) in summary.counters.items():
+                counter = counters.setdefault(item, [0, 0, 0])
+                counter[0] += count
+                counter[1] += error
+                counter[2] += summary.floor
+        merged = {item: [count + floors - floor, error + floors - floor] for item, (count, error, floor) in counters.items()}
+        items = sorted(merged.items(), key=lambda item: (-item[1][0], str(item[0])))
+        floor = max(floors, items[capacity][1][0]) if len(items)>capacity else floors
+        return cls(capacity, dict(items[:capacity]), floor)
+
+    #(item, count, error) of the items with the largest counts
+    def top(self, limit=None):
+        items = sorted(self.counters.items(), key=lambda item: (-item[1][0], str(item[0])))
+        return [(item, count, error) for item, (count, error) in items[:limit]]
+
+    #stored as JSON; items are strings (artists) or lists (tracks)
+    def to_json(self):
+        return {"capacity": self.capacity, "floor": self.floor,
+                "counters": [[list(item) if isinstance(item, tuple) else item, count, error] for item, (count, error) in self.counters.items()]}
+
+    @classmethod
+    def from_json(cls, data):
+        counters = {tuple(item) if isinstance(item, list) else item: [count, error] for item, count, error in data["counters"]}
+        return cls(data["capacity"], counters, data["floor"])
+
+#distinct items: HyperLogLog with 2^precision registers, relative standard error 1.04/sqrt(2^precision)
+#stored sparse (only registers that are set), as a day has few distinct items
+class HyperLogLog:
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+
+    def add(self, item):
+        value = int.from_bytes(hashlib.blake2b(item.encode('utf-8'), digest_size=8).digest(), 'big')
+        index = value >> (64 - self.precision)
+        rest = value & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank>self.registers[index]:
+            self.registers[index] = rank
+
+    #registers set in "sparse" (from to_bytes) are merged into this sketch
+    def merge_bytes(self, sparse):
+        registers = self.registers
+        for index, rank in struct.iter_unpack('>HB', sparse):
+            if rank>registers[index]:
+                registers[index] = rank
+
+    def count(self):
+        m = len(self.registers)
+        estimate = (0.7213/(1 + 1.079/m)) * m * m / sum(2.0**-rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate<=2.5*m and zeros: #small range correction (linear counting)
+            estimate = m * math.log(m/zeros)
+        return round(estimate)
+
+    def relative_error(self):
+        return 1.04/math.sqrt(len(self.registers))
+
+    def to_bytes(self):
+        return b"".join(struct.pack('>HB', index, rank) for index, rank in enumerate(self.registers) if rank)
+
+#rollup rows of the given (day, account) pairs (two arrays: days and accounts); "key" is the item of the sketches
+SKETCH_SOURCES = {
+    "tracks": "SELECT day, account, artist1, artist2, artist3, track_name, streams, ms FROM daily_track_stats WHERE (day, account) IN (SELECT * FROM unnest(%s::date[], %s::text[]));",
+    "artists": "SELECT day, account, artist, streams, ms FROM daily_artist_stats WHERE (day, account) IN (SELECT * FROM unnest(%s::date[], %s::text[]));"
+}
+
+UPSERT = """
+    INSERT INTO daily_sketches (day, account, kind, streams, ms, distinct_items)
+    VALUES (%s, %s, %s, %s::jsonb, %s::jsonb, %s)
+    ON CONFLICT (day, kind, account) DO UPDATE SET streams = EXCLUDED.streams, ms = EXCLUDED.ms, distinct_items = EXCLUDED.distinct_items;
+"""
+
+#parameters of SKETCH_SOURCES for the (day, account) pairs
+def source_params(pairs):
+    return ([day for day, account in pairs], [account for day, account in pairs])
+
+def item_key(kind, row):
+    if kind=="tracks":
+        return tuple(row[2:6])
+    return row[2]
+
+#parameters of UPSERT for every (day, account) pair of the rows of SKETCH_SOURCES[kind]; pairs without rows get
+#empty sketches, so a day whose plays were removed is cleared
+def build_sketches(kind, pairs, rows, capacity):
+    streams = {pair: {} for pair in pairs}
+    ms = {pair: {} for pair in pairs}
+    for row in rows:
+        pair = (row[0], row[1])
+        key = item_key(kind, row)
+        if row[-2]>0:
+            streams[pair][key] = row[-2]
+        if row[-1]>0:
+            ms[pair][key] = row[-1]
+    result = []
+    for day, account in pairs:
+        distinct = HyperLogLog()
+        for key in ms[(day, account)].keys() | streams[(day, account)].keys():
+            distinct.add(key if isinstance(key, str) else "\x1f".join(part or "" for part in key))
+        result.append((day, account, kind,
+                       json.dumps(SpaceSaving.from_counts(capacity, streams[(day, account)]).to_json()),
+                       json.dumps(SpaceSaving.from_counts(capacity, ms[(day, account)]).to_json()),
+                       distinct.to_bytes()))
+    return result
@@ -0,0 +1,128 @@
+import argparse
+import json
+import os
+import shutil
+import psycopg
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tzlocal
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#exports "history" to Parquet files partitioned by month (SNAPSHOT_DIR/history/month=YYYY-MM/part-<xid>-<n>.parquet),
+#read by STATS with STATS_BACKEND=duckdb; every run appends the records written (inserted or updated) since the last run,
+#by transaction ("written_xid", see migrations/012-add-history-written-xid.py) instead of id, as ids are assigned in
+#insert order and not in commit order; a record changed after its export is appended again and readers keep the
+#version with the largest "written_xid" of every id; deleted records are only removed by --full
+
+#use time zone from the environment if set; otherwise default to system time zone
+if 'IANA_TIMEZONE' in os.environ:
+    current_timezone = os.environ['IANA_TIMEZONE']
+else:
+    current_timezone = tzlocal.get_localzone_name()
+
+#----------------------------------------------DB CONNECTION-----------------------------------------------------------
+#using cloud hosted PostgreSQL database
+host = os.environ['DB_HOST']
+db_name = os.environ['DB_NAME']
+user = os.environ['DB_USER']
+password = os.environ['DB_PASSWORD']
+port = os.environ['DB_PORT']
+
+conninfo = f"host={host} port={port} dbname={db_name} user={user} password={password} sslmode='require'"
+
+schema = pa.schema([
+    ('id', pa.int64()),
+    ('written_xid', pa.int64()),
+    ('account', pa.string()),
+    ('artist1', pa.string()),
+    ('artist2', pa.string()),
+    ('artist3', pa.string()),
+    ('artists', pa.list_(pa.string())),
+    ('track_name', pa.string()),
+    ('played_at', pa.timestamp('us', tz='UTC')),
+    ('progress', pa.int64()),
+    ('duration', pa.int64())
+])
+
+#oldest transaction still running: all transactions before it have finished, so the records they wrote are visible
+#to every later query and no record below it can appear afterwards; it is the end of a run and the watermark of the next
+HORIZON = "SELECT pg_snapshot_xmin(pg_current_snapshot())::text::int8;"
+
+#records written by the transactions from the watermark (NULL - first run, records not written since the migration
+#included) up to the horizon
+query = """
+    SELECT h.id, h.written_xid::text::int8, h.account, h.artist1, h.artist2, h.artist3,
+        ARRAY(SELECT a.name FROM history_artists ha JOIN artists a ON a.id = ha.artist_id
+              WHERE ha.history_id = h.id ORDER BY ha.position) as artists,
+        h.track_name, h.played_at, h.progress, h.duration,
+        to_char(h.played_at AT TIME ZONE %(tz)s, 'YYYY-MM') as month
+    FROM history h
+    WHERE CASE WHEN %(watermark)s::int8 IS NULL THEN h.written_xid IS NULL OR h.written_xid < %(horizon)s::text::xid8
+        ELSE h.written_xid >= %(watermark)s::text::xid8 AND h.written_xid < %(horizon)s::text::xid8 END
+    ORDER BY h.id
+"""
+
+#None before the first run (and for snapshots with an id watermark, which are exported again; readers keep one version)
+def read_watermark(path):
+    try:
+        with open(path, 'r') as file:
+            return json.load(file).get('xid')
+    except FileNotFoundError:
+        return None
+
+def write_watermark(path, watermark):
+    with open(path + '.tmp', 'w') as file:
+        json.dump({"xid": watermark}, file)
+    os.replace(path + '.tmp', path)
+
+#write a batch of records, one file per month; "name" is unique per run and batch, as a record may be written again
+def write_batch(directory, rows, name):
+    months = {}
+    for row in rows:
+        months.setdefault(row[-1], []).append(row[:-1])
+    for month, records in months.items():
+        partition = os.path.join(directory, 'history', f"month={month}")
+        os.makedirs(partition, exist_ok=True)
+        columns = list(zip(*records))
+        table = pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+        pq.write_table(table, os.path.join(partition, f"part-{name}.parquet"))
+
+#the watermark is written after the last batch; records of an interrupted run are written again by the next one
+def export(directory, batch_size):
+    watermark_path = os.path.join(directory, 'watermark.json')
+    watermark = read_watermark(watermark_path)
+    exported = 0
+    with psycopg.connect(conninfo) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(HORIZON)
+            horizon = cursor.fetchone()[0]
+        with conn.cursor(name="snapshot") as cursor:
+            cursor.execute(query, {"watermark": watermark, "horizon": str(horizon), "tz": current_timezone})
+            batch = 0
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                write_batch(directory, rows, f"{horizon}-{batch}")
+                exported += len(rows)
+                batch += 1
+    write_watermark(watermark_path, horizon)
+    return exported, horizon
+
+def main():
+    parser = argparse.ArgumentParser(description="Export history to a Parquet snapshot.")
+    parser.add_argument('--dir', default=os.environ.get('SNAPSHOT_DIR', 'snapshot'), help="snapshot directory")
+    parser.add_argument('--batch-size', type=int, default=100000, help="records per Parquet file")
+    parser.add_argument('--full', action='store_true', help="delete the snapshot and export all records again")
+    args = parser.parse_args()
+
+    if args.full and os.path.isdir(args.dir):
+        shutil.rmtree(args.dir)
+    os.makedirs(args.dir, exist_ok=True)
+    exported, watermark = export(args.dir, args.batch_size)
+    print(f"{exported} records exported, watermark (transaction): {watermark}.")
+
+if __name__ == '__main__':
+    main()
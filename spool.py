@@ -0,0 +1,133 @@
+import json
+import sqlite3
+import time
+from datetime import datetime
+
+#append-only local spool of plays (SQLite in WAL mode)
+#the worker writes every change of a play here; a drainer copies pending changes to "history" in batches
+#every play has a "play_id", so copying the same change again (e.g. after a crash) does not create duplicates
+class Spool:
+    #columns copied to "history"; all artists of a play (JSON list) are kept in "artists"
+    columns = ['play_id', 'account', 'artist1', 'artist2', 'artist3', 'track_name', 'played_at', 'progress', 'duration']
+    spool_columns = columns + ['artists']
+    #columns copied to "sessions"
+    session_columns = ['session_id', 'account', 'started_at', 'ended_at', 'tracks', 'ms']
+
+    def __init__(self, path='spool.db', keep=86400):
+        self.keep = keep
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS plays (
+                play_id TEXT PRIMARY KEY,
+                account TEXT NOT NULL,
+                artist1 TEXT,
+                artist2 TEXT,
+                artist3 TEXT,
+                track_name TEXT,
+                played_at TEXT NOT NULL,
+                progress INTEGER,
+                duration INTEGER,
+                version INTEGER NOT NULL DEFAULT 1,
+                synced_version INTEGER NOT NULL DEFAULT 0,
+                recorded_at REAL NOT NULL
+            );
+        """)
+        #spools created before all artists were kept
+        if 'artists' not in [row[1] for row in self.conn.execute("PRAGMA table_info(plays);")]:
+            self.conn.execute("ALTER TABLE plays ADD COLUMN artists TEXT;")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS plays_pending_idx ON plays (recorded_at) WHERE version > synced_version;")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                account TEXT NOT NULL,
+                started_at TEXT NOT NULL,
+                ended_at TEXT NOT NULL,
+                tracks INTEGER,
+                ms INTEGER,
+                version INTEGER NOT NULL DEFAULT 1,
+                synced_version INTEGER NOT NULL DEFAULT 0,
+                recorded_at REAL NOT NULL
+            );
+        """)
+        self.conn.commit()
+
+    #insert a new play or update the progress of an existing one
+    def write(self, play):
+        query = """
+            INSERT INTO plays (play_id, account, artist1, artist2, artist3, track_name, played_at, progress, duration, artists, recorded_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (play_id) DO UPDATE SET progress = excluded.progress, version = version + 1;
+        """
+        values = [play[column] for column in self.columns]
+        values[6] = values[6].isoformat()
+        values.append(json.dumps(play.get('artists') or [play['artist1']]))
+        self.conn.execute(query, values + [time.time()])
+        self.conn.commit()
+
+    def to_play(self, row):
+        play = dict(zip(self.spool_columns, row))
+        play['played_at'] = datetime.fromisoformat(play['played_at'])
+        play['artists'] = json.loads(play['artists']) if play['artists'] else [play['artist1']]
+        return play
+
+    #last play of the account that reached the spool, None if there is none
+    def last_play(self, account):
+        query = f"SELECT {', '.join(self.spool_columns)} FROM plays WHERE account = ? ORDER BY recorded_at DESC LIMIT 1;"
+        row = self.conn.execute(query, (account,)).fetchone()
+        return self.to_play(row) if row else None
+
+    #changes not yet copied to the database, oldest first; returns (play, version) pairs
+    def pending(self, limit=500):
+        query = f"SELECT {', '.join(self.spool_columns)}, version FROM plays WHERE version > synced_version ORDER BY recorded_at LIMIT ?;"
+        rows = self.conn.execute(query, (limit,)).fetchall()
+        return [(self.to_play(row[:-1]), row[-1]) for row in rows]
+
+    #mark changes as copied; a play changed in the meantime stays pending
+    def mark_synced(self, pending):
+        query = "UPDATE plays SET synced_version = ? WHERE play_id = ? AND version >= ?;"
+        self.conn.executemany(query, [(version, play['play_id'], version) for play, version in pending])
+        #copied plays are kept for a while, the newest one restores the worker's state after a restart
+        self.conn.execute("DELETE FROM plays WHERE version = synced_version AND recorded_at < ?;", (time.time()-self.keep,))
+        self.conn.commit()
+
+    #insert a new listening session or update an existing one
+    def write_session(self, session):
+        query = """
+            INSERT INTO sessions (session_id, account, started_at, ended_at, tracks, ms, recorded_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (session_id) DO UPDATE SET ended_at = excluded.ended_at, tracks = excluded.tracks, ms = excluded.ms, version = version + 1;
+        """
+        values = [session[column] for column in self.session_columns]
+        values[2] = values[2].isoformat()
+        values[3] = values[3].isoformat()
+        self.conn.execute(query, values + [time.time()])
+        self.conn.commit()
+
+    def to_session(self, row):
+        session = dict(zip(self.session_columns, row))
+        session['started_at'] = datetime.fromisoformat(session['started_at'])
+        session['ended_at'] = datetime.fromisoformat(session['ended_at'])
+        return session
+
+    #last session of the account that reached the spool, None if there is none
+    def last_session(self, account):
+        query = f"SELECT {', '.join(self.session_columns)} FROM sessions WHERE account = ? ORDER BY started_at DESC LIMIT 1;"
+        row = self.conn.execute(query, (account,)).fetchone()
+        return self.to_session(row) if row else None
+
+    #session changes not yet copied to the database; returns (session, version) pairs
+    def pending_sessions(self, limit=500):
+        query = f"SELECT {', '.join(self.session_columns)}, version FROM sessions WHERE version > synced_version ORDER BY recorded_at LIMIT ?;"
+        rows = self.conn.execute(query, (limit,)).fetchall()
+        return [(self.to_session(row[:-1]), row[-1]) for row in rows]
+
+    def mark_sessions_synced(self, pending):
+        query = "UPDATE sessions SET synced_version = ? WHERE session_id = ? AND version >= ?;"
+        self.conn.executemany(query, [(version, session['session_id'], version) for session, version in pending])
+        self.conn.execute("DELETE FROM sessions WHERE version = synced_version AND recorded_at < ?;", (time.time()-self.keep,))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
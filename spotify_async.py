@@ -0,0 +1,60 @@
+import asyncio
+import time
+import httpx
+from spotipy.exceptions import SpotifyException
+
+#non-blocking client for the Spotify Web API endpoints used by the worker
+#tokens are still managed (and cached) by spotipy's SpotifyOAuth
+class AsyncSpotify:
+    prefix = "https://api.spotify.com/v1/"
+
+    def __init__(self, auth_manager, client=None, limiter=None, timeout=10):
+        self.auth_manager = auth_manager
+        #the http client can be shared between accounts, it is closed by whoever created it
+        self.own_client = client is None
+        self.client = client if client is not None else httpx.AsyncClient(timeout=timeout)
+        self.limiter = limiter
+        self.token_info = None
+
+    #refreshing a token is a blocking request, it runs in a thread and only when the token is about to expire
+    def refresh_token(self):
+        token_info = self.auth_manager.validate_token(self.auth_manager.cache_handler.get_cached_token())
+        if token_info is None: #no cached token, authorize
+            self.auth_manager.get_access_token(as_dict=False)
+            token_info = self.auth_manager.cache_handler.get_cached_token()
+        return token_info
+
+    async def get_token(self):
+        if self.token_info is None or self.token_info['expires_at'] - time.time() < 60:
+            self.token_info = await asyncio.to_thread(self.refresh_token)
+        return self.token_info['access_token']
+
+    async def request(self, method, url, params=None):
+        token = await self.get_token()
+        if self.limiter is not None:
+            await self.limiter.acquire()
+        headers = {"Authorization": f"Bearer {token}"}
+        response = await self.client.request(method, self.prefix + url, params=params, headers=headers)
+        if response.status_code>=400:
+            try:
+                msg = response.json()['error']['message']
+            except Exception:
+                msg = response.text or "error"
+            raise SpotifyException(response.status_code, -1, f"{response.url}:\n {msg}", headers=response.headers)
+        if response.status_code==204 or not response.content: #no content, e.g. no active playback
+            return None
+        return response.json()
+
+    async def current_user_playing_track(self):
+        return await self.request("GET", "me/player/currently-playing")
+
+    async def queue(self):
+        return await self.request("GET", "me/player/queue")
+
+    async def add_to_queue(self, track_id):
+        uri = track_id if track_id.startswith("spotify:") else f"spotify:track:{track_id}"
+        return await self.request("POST", "me/player/queue", params={"uri": uri})
+
+    async def close(self):
+        if self.own_client:
+            await self.client.aclose()
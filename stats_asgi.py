@@ -0,0 +1,233 @@
+import asyncio
+import contextlib
+import os
+import psycopg
+import uvicorn
+from psycopg_pool import AsyncConnectionPool, PoolTimeout, TooManyRequests
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from result_cache import ResultCache
+from query_compiler import SHAPES, QueryCompiler, RequestError, execute
+from stats_config import require_conninfo, stats_config
+from stats_encoding import build_rows, encode, encode_json, response_format, row_encoder
+from stats_format import build_result, cache_end, cache_key, dumps, format_row, wants_ndjson
+from stats_metrics import Metrics, PhaseTimer, SlowQueryLog
+
+#production serving mode of STATS: the same routes and JSON output as STATS.py, served by an ASGI server
+#with an async connection pool; every query runs with a statement timeout and requests are rejected (429)
+#when the pool is saturated, so a slow query doesn't stall the other clients
+#settings are read when the app is created (see stats_config.py), the pool is opened at startup
+#run with: uvicorn --factory stats_asgi:create_app (or python stats_asgi.py)
+
+def json_response(data, status=200, headers=None):
+    return Response(dumps(data), status_code=status, headers=headers, media_type="application/json")
+
+#"config" defaults to stats_config() (the environment); a pool passed in is opened and closed by its owner
+def create_app(config=None, pool=None):
+    config = config if config is not None else stats_config()
+    #with STATS_BACKEND=duckdb, the endpoints of the snapshot are answered from it (as in STATS.py), without a pool
+    backend = config["backend"]
+    snapshot = None
+    own_pool = False
+    if backend=="duckdb":
+        from stats_duckdb import SnapshotBackend
+        snapshot = SnapshotBackend(config["snapshot_dir"])
+    elif pool is None:
+        pool = AsyncConnectionPool(conninfo=require_conninfo(config), min_size=1, max_size=config["pool_size"],
+                                   timeout=config["pool_timeout"], max_waiting=config["max_waiting"], open=False)
+        own_pool = True
+    compiler = QueryCompiler(config["timezone"])
+    statement_timeout = config["statement_timeout"]
+    stream_chunk = config["stream_chunk"]
+    result_cache = ResultCache(config["cache_size"])
+    metrics = Metrics()
+    slow_queries = SlowQueryLog(config["slow_query_ms"] if config["debug_routes"] else None, config["slow_query_log"])
+    #running EXPLAIN tasks (referenced until they finish)
+    explaining = set()
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        #with warm-up, the server starts accepting requests once the first connection is made
+        if own_pool:
+            await pool.open(wait=config["warmup"])
+        if backend!="duckdb" and result_cache.max_entries>0 and config["conninfo"]:
+            result_cache.start(config["conninfo"])
+        try:
+            yield
+        finally:
+            #the listener thread is stopped without blocking the event loop
+            await asyncio.to_thread(result_cache.stop)
+            if own_pool:
+                await pool.close()
+
+    #connection with the statement timeout set for the current transaction
+    @contextlib.asynccontextmanager
+    async def connection():
+        async with pool.connection() as conn:
+            await conn.execute("SELECT set_config('statement_timeout', %s, true);", (str(statement_timeout),))
+            yield conn
+
+    async def run_query(endpoint, req, shape, params, timer):
+        if backend=="duckdb":
+            #DuckDB queries block, so they run in a thread
+            rows = await asyncio.to_thread(lambda: list(snapshot.rows(endpoint, req, shape)))
+            timer.lap("execute")
+            result = build_result(endpoint, req, shape, params, rows)
+            timer.lap("format")
+            return result
+        async with connection() as conn:
+            started = timer.lap("pool")
+            async with conn.cursor() as cursor:
+                await execute(cursor, shape, params)
+                executed = timer.lap("execute")
+                rows = await cursor.fetchall()
+                columns = [desc[0] for desc in cursor.description]
+                timer.lap("fetch")
+        if slow_queries.begin(shape, executed-started):
+            task = asyncio.create_task(explain_query(endpoint, shape, params, executed-started))
+            explaining.add(task)
+            task.add_done_callback(explaining.discard)
+        result = build_rows(endpoint, req, shape, params, columns, rows)
+        timer.lap("format")
+        return result
+
+    #plan of a slow query (run again with EXPLAIN ANALYZE) for /debug/slow-queries
+    async def explain_query(endpoint, shape, params, seconds):
+        try:
+            async with connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(slow_queries.explain + SHAPES[shape], params)
+                    plan = "\n".join(row[0] for row in await cursor.fetchall())
+        except Exception as e:
+            plan = f"Plan couldn't be captured: {e}"
+        slow_queries.record(endpoint, shape, seconds, SHAPES[shape], params, plan)
+
+    #server-side cursor of the query shape for an NDJSON response: the connection is taken and the query started
+    #before the response is sent, so a saturated pool (429) or a cancelled query (503) is reported as for the other
+    #responses; "stack" releases the connection when the stream ends
+    async def open_stream(shape, params, timer):
+        stack = contextlib.AsyncExitStack()
+        try:
+            conn = await stack.enter_async_context(connection())
+            timer.lap("pool")
+            cursor = await stack.enter_async_context(conn.cursor(name="stats_stream"))
+            await cursor.execute(SHAPES[shape], params)
+            timer.lap("execute")
+        except BaseException:
+            await stack.aclose()
+            raise
+        return stack, cursor
+
+    async def stream_rows(endpoint, req, stack, cursor):
+        try:
+            encode_row = row_encoder(endpoint, req, [desc[0] for desc in cursor.description])
+            while True:
+                rows = await cursor.fetchmany(stream_chunk)
+                if not rows:
+                    break
+                for row in rows:
+                    yield encode_json(encode_row(row))
+        finally:
+            await stack.aclose()
+
+    #a plain generator: the response iterates it in a thread
+    def stream_snapshot(endpoint, req, shape):
+        for row in snapshot.rows(endpoint, req, shape, stream_chunk):
+            yield dumps(format_row(endpoint, req, row))
+
+    async def respond(request, endpoint):
+        timer = PhaseTimer()
+        try:
+            req = compiler.parse(endpoint, request.query_params)
+            shape, params = compiler.bind(endpoint, req)
+        except RequestError as e:
+            return json_response({"error":str(e)}, 400)
+        timer.lap("parse")
+        if backend=="duckdb" and (endpoint not in snapshot.endpoints or req["approx"]):
+            return json_response({"error":"Not available with the snapshot backend."}, 501)
+        headers = {'X-Query-Shape': shape}
+        accept = request.headers.get('accept', '')
+        #every request with a query shape is recorded with its status, including the phase it failed in
+        status = 500
+        try:
+            if endpoint in ['streams', 'duration'] and not req["approx"] and wants_ndjson(request.query_params, accept):
+                if backend=="duckdb":
+                    status = 200
+                    return StreamingResponse(stream_snapshot(endpoint, req, shape), headers=headers, media_type='application/x-ndjson')
+                stack, cursor = await open_stream(shape, params, timer)
+                status = 200
+                #the stack is also closed after the response, in case the stream was never started
+                return StreamingResponse(stream_rows(endpoint, req, stack, cursor), headers=headers,
+                                         media_type='application/x-ndjson', background=BackgroundTask(stack.aclose))
+
+            key = cache_key(shape, params)
+            generation = result_cache.generation
+            cached = result_cache.get(key)
+            timer.lap("cache")
+            if cached is None:
+                cached = await run_query(endpoint, req, shape, params, timer)
+                result_cache.put(key, cached, cache_end(endpoint, req), generation)
+            result, next_page = cached
+            if next_page:
+                headers['X-Next-Page'] = next_page
+            body, mimetype = encode(result, response_format(accept))
+            timer.lap("serialize")
+            headers['Server-Timing'] = timer.server_timing()
+            status = 200
+            return Response(body, status_code=200, headers=headers, media_type=mimetype)
+        except (PoolTimeout, TooManyRequests):
+            timer.lap("pool")
+            status = 429
+            return json_response({"error":"Too many requests. Try again later."}, 429, {'Retry-After': '1'})
+        except psycopg.errors.QueryCanceled:
+            timer.lap("execute")
+            status = 503
+            return json_response({"error":"The query took too long. Select a shorter date range."}, 503)
+        except Exception:
+            timer.lap("error")
+            raise
+        finally:
+            metrics.observe(endpoint, shape, timer, status)
+
+    async def get_stats_by_streams(request):
+        return await respond(request, 'streams')
+
+    async def get_stats_by_duration(request):
+        return await respond(request, 'duration')
+
+    async def get_summary(request):
+        return await respond(request, 'summary')
+
+    async def get_timeline(request):
+        return await respond(request, 'timeline')
+
+    async def get_sessions(request):
+        return await respond(request, 'sessions')
+
+    async def get_streaming_time(request):
+        return await respond(request, 'total')
+
+    async def get_metrics(request):
+        return Response(metrics.render(), media_type='text/plain; version=0.0.4')
+
+    async def get_slow_queries(request):
+        return json_response(slow_queries.list())
+
+    routes = [
+        Route('/statistics/streams', get_stats_by_streams, methods=['GET']),
+        Route('/statistics/duration', get_stats_by_duration, methods=['GET']),
+        Route('/statistics/summary', get_summary, methods=['GET']),
+        Route('/statistics/timeline', get_timeline, methods=['GET']),
+        Route('/statistics/sessions', get_sessions, methods=['GET']),
+        Route('/statistics/total', get_streaming_time, methods=['GET']),
+        Route('/metrics', get_metrics, methods=['GET'])
+    ]
+    #SQL and parameters of slow queries are only served with STATS_DEBUG_ROUTES=true
+    if config["debug_routes"]:
+        routes.append(Route('/debug/slow-queries', get_slow_queries, methods=['GET']))
+    return Starlette(routes=routes, lifespan=lifespan)
+
+if __name__ == '__main__':
+    uvicorn.run(create_app(), host=os.environ.get('STATS_HOST', '127.0.0.1'), port=int(os.environ.get('STATS_PORT', 8000)))
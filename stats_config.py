@@ -0,0 +1,52 @@
+import os
+import tzlocal
+from dotenv import load_dotenv
+
+#settings of STATS (STATS.py and stats_asgi.py), read from the environment when an app is created (not at import)
+def stats_config(environ=None):
+    if environ is None:
+        load_dotenv()
+        environ = os.environ
+
+    #----------------------------------------------DB CONNECTION-------------------------------------------------------
+    #using cloud hosted PostgreSQL database; not required when a pool is passed to create_app or with the snapshot backend
+    conninfo = None
+    if 'DB_HOST' in environ:
+        conninfo = f"host={environ['DB_HOST']} port={environ['DB_PORT']} dbname={environ['DB_NAME']} user={environ['DB_USER']} password={environ['DB_PASSWORD']} sslmode='require'"
+
+    #use time zone from the environment if set; otherwise default to system time zone
+    if 'IANA_TIMEZONE' in environ:
+        timezone = environ['IANA_TIMEZONE']
+    else:
+        timezone = tzlocal.get_localzone_name()
+
+    slow_query_ms = environ.get('STATS_SLOW_QUERY_MS')
+    return {
+        "conninfo": conninfo,
+        "timezone": timezone,
+        #statistics are read from PostgreSQL, or from the Parquet snapshot (see snapshot.py) with STATS_BACKEND=duckdb
+        "backend": environ.get('STATS_BACKEND', 'postgres'),
+        "snapshot_dir": environ.get('SNAPSHOT_DIR', 'snapshot'),
+        #connections of stats_asgi.py; seconds a request waits for a connection before it is rejected,
+        #and requests waiting for a connection (further requests are rejected right away)
+        "pool_size": int(environ.get('STATS_POOL_SIZE', 10)),
+        "pool_timeout": float(environ.get('STATS_POOL_TIMEOUT', 5)),
+        "max_waiting": int(environ.get('STATS_MAX_WAITING', 50)),
+        "statement_timeout": int(environ.get('STATS_STATEMENT_TIMEOUT', 10000)),
+        #rows fetched at a time for NDJSON responses
+        "stream_chunk": int(environ.get('STATS_STREAM_CHUNK', 1000)),
+        #responses are cached until "history" changes (see result_cache.py); STATS_CACHE_SIZE=0 disables the cache
+        "cache_size": int(environ.get('STATS_CACHE_SIZE', 256)),
+        #queries slower than this many milliseconds are explained for /debug/slow-queries (disabled if not set);
+        #the route (and so the capture) is only enabled with STATS_DEBUG_ROUTES=true, as it shows SQL parameters
+        "slow_query_ms": float(slow_query_ms) if slow_query_ms else None,
+        "slow_query_log": int(environ.get('STATS_SLOW_QUERY_LOG', 20)),
+        "debug_routes": environ.get('STATS_DEBUG_ROUTES', 'false')=="true",
+        #connect to the database when the app is created instead of on the first request
+        "warmup": environ.get('STATS_WARMUP', 'false')=="true"
+    }
+
+def require_conninfo(config):
+    if config["conninfo"] is None:
+        raise RuntimeError("Database is not configured: set DB_HOST, DB_NAME, DB_USER, DB_PASSWORD and DB_PORT.")
+    return config["conninfo"]
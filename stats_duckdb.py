@@ -0,0 +1,116 @@
+import glob
+import os
+import threading
+import duckdb
+
+#STATS backend reading the Parquet snapshot written by snapshot.py with DuckDB (STATS_BACKEND=duckdb),
+#so analytical queries run offline and never touch the primary database
+#queries give the same rows as the PostgreSQL query shapes (query_compiler.py), computed from "history" only
+
+#lexicographic comparison of keys with the pagination parameters
+def after_keys(keys, i=0):
+    if i==len(keys)-1:
+        return f"{keys[i]} > $after{i}"
+    return f"({keys[i]} > $after{i} OR ({keys[i]} = $after{i} AND {after_keys(keys, i+1)}))"
+
+TRACK_KEYS = ["COALESCE(artist1, '')", "COALESCE(artist2, '')", "COALESCE(artist3, '')", "track_name"]
+
+class SnapshotBackend:
+    #endpoints answered from the snapshot
+    endpoints = ['streams', 'duration', 'total']
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.conn = duckdb.connect()
+        self.lock = threading.Lock()
+
+    def files(self):
+        return os.path.join(self.directory, 'history', '*', '*.parquet')
+
+    #records of the snapshot: a record changed after its export is in several files, the version written last is kept
+    #(files of snapshots exported before "written_xid" have NULL, any newer version is kept instead)
+    def latest(self):
+        return f"""SELECT * FROM read_parquet('{self.files()}', hive_partitioning = true, union_by_name = true)
+            QUALIFY row_number() OVER (PARTITION BY id ORDER BY written_xid DESC NULLS LAST) = 1"""
+
+    #SQL and parameters of a request, for the shape chosen by the compiler
+    def query(self, endpoint, req, shape):
+        params = {}
+        where_part = []
+        if req["start"] is not None:
+            where_part.append("played_at >= $start")
+            params["start"] = req["start"]
+        if req["end"] is not None:
+            where_part.append("played_at <= $end")
+            params["end"] = req["end"]
+        if req["account"] is not None:
+            where_part.append("account = $account")
+            params["account"] = req["account"]
+
+        if endpoint=="total":
+            if req["artists"]:
+                where_part.append("len(list_filter(artists, name -> name LIKE $artist)) > 0")
+                params["artist"] = req["artists"][0]
+            where = " WHERE " + " AND ".join(where_part) if where_part else ""
+            return f"SELECT SUM(progress)::BIGINT as ms FROM history{where}", params
+
+        measure = "streams" if endpoint=="streams" else "ms"
+        value = "COUNT(*)" if measure=="streams" else "SUM(progress)::BIGINT"
+        if measure=="streams":
+            where_part.append("progress>=45000")
+        source = "history"
+        if shape.endswith(".top_artists"):
+            source = "(SELECT UNNEST(artists) as artist, account, played_at, progress FROM history)"
+            group_part = "artist"
+            keys = ["artist"]
+        elif shape.endswith(".artist_tracks"):
+            where_part.append("list_contains(artists, $artist)")
+            params["artist"] = req["artists"][0]
+            group_part = "track_name"
+            keys = ["track_name"]
+        else:
+            if shape.endswith(".track"):
+                where_part.append("list_has_any(artists, $artists)")
+                where_part.append("track_name LIKE $prefix")
+                params["artists"] = sorted(set(req["artists"]))
+                params["prefix"] = req["name"] + '%'
+            group_part = "artist1, artist2, artist3, track_name"
+            keys = TRACK_KEYS
+
+        having = []
+        if req["after"]:
+            _, after_value, after = req["after"]
+            having.append(f"({value} < $after_value OR ({value} = $after_value AND {after_keys(keys)}))")
+            params["after_value"] = after_value
+            for i, key in enumerate(after):
+                params[f"after{i}"] = key
+        query = f"SELECT {value} as {measure}, {group_part} FROM {source}"
+        if where_part:
+            query += " WHERE " + " AND ".join(where_part)
+        query += f" GROUP BY {group_part}"
+        if having:
+            query += " HAVING " + " AND ".join(having)
+        query += f" ORDER BY {measure} DESC, {', '.join(keys)}"
+        if req["limit"] is not None:
+            query += f" LIMIT {int(req['limit'])}"
+        return query, params
+
+    #rows of the request as dicts, read in chunks
+    def rows(self, endpoint, req, shape, chunk=1000):
+        if not glob.glob(self.files()):
+            return
+        query, params = self.query(endpoint, req, shape)
+        with self.lock:
+            cursor = self.conn.cursor()
+        try:
+            cursor.execute(f"CREATE OR REPLACE TEMP VIEW history AS {self.latest()}")
+            cursor.execute(query, params)
+            columns = [desc[0] for desc in cursor.description]
+            while True:
+                rows = cursor.fetchmany(chunk)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(columns, row))
+        finally:
+            cursor.close()
@@ -0,0 +1,105 @@
+from query_compiler import page_token
+from stats_format import best_match, build_result, dumps, format_time
+
+#response encoding of STATS, shared by STATS.py (Flask) and stats_asgi.py: rows are read as tuples and turned into
+#response rows by an encoder built once per result from the column names (instead of dict(zip()) and format_row
+#per row), JSON is written with orjson when it is installed, and machine clients can ask for MessagePack
+#or Arrow IPC instead of JSON; JSON output is byte for byte the same as stats_format.dumps
+
+#optional encoders, used only if installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+ARROW = "application/vnd.apache.arrow.stream"
+
+#response formats that can be served, preferred first
+def available_formats():
+    return [JSON] + ([MSGPACK] if msgpack is not None else []) + ([ARROW] if pyarrow is not None else [])
+
+#format preferred in the Accept header (q-values included) among the installed ones, JSON if none is acceptable
+def response_format(accept):
+    return best_match(accept, available_formats()) or JSON
+
+#a function that turns a row tuple with these columns into the same dict as format_row(endpoint, req, dict(zip(columns, row)))
+def row_encoder(endpoint, req, columns):
+    index = {column: i for i, column in enumerate(columns)}
+    artists = [index[f"artist{i}"] for i in range(1, 4)] if "artist1" in index else None
+    ms = index.get("ms")
+    plain = [(column, i) for column, i in index.items() if i!=ms and (artists is None or i not in artists)]
+    if endpoint=="total":
+        duration_key = "total streaming time"
+        extra = {"artist": req["artists"][0]} if req["artists"] else {}
+    else:
+        duration_key = "totalDuration"
+        extra = {}
+
+    def encode(row):
+        result = {column: row[i] for column, i in plain}
+        if artists is not None:
+            first, second, third = row[artists[0]], row[artists[1]], row[artists[2]]
+            if first: #artists are joined only if the row has a main artist (as in format_result)
+                result['artists'] = ", ".join([artist for artist in (first, second, third) if artist is not None])
+            else:
+                result['artist1'], result['artist2'], result['artist3'] = first, second, third
+        if ms is not None:
+            result.update(extra)
+            result[duration_key] = format_time(row[ms])
+        return result
+    return encode
+
+#build_result for row tuples: list endpoints are encoded from the tuples, the others are built from dicts
+def build_rows(endpoint, req, shape, params, columns, rows):
+    if endpoint not in ['streams', 'duration', 'total'] or shape.endswith(".approx"):
+        return build_result(endpoint, req, shape, params, [dict(zip(columns, row)) for row in rows])
+    next_page = None
+    if rows and params.get('limit') and len(rows)==params['limit']:
+        next_page = page_token(shape, dict(zip(columns, rows[-1])))
+    encode = row_encoder(endpoint, req, columns)
+    result = [encode(row) for row in rows]
+    if not result:
+        result = {"message":"No data found for the selected parameters."}
+    return result, next_page
+
+#same bytes as dumps(data); orjson writes non-ASCII characters (and DEL) as they are while dumps escapes them,
+#and escaping them afterwards in Python is slower than the C encoder of dumps, so such responses use dumps;
+#floats are written differently by orjson (e.g. 1e20 for 1e+20), so results with floats (sessions) use dumps too
+def encode_json(data):
+    if orjson is not None and not (isinstance(data, dict) and any(isinstance(value, float) for value in data.values())):
+        try:
+            body = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+        except orjson.JSONEncodeError: #types orjson doesn't write (e.g. int subclasses)
+            body = None
+        if body is not None and body.isascii() and b"\x7f" not in body:
+            return body.decode() + "\n"
+    return dumps(data)
+
+#response body in the format "mimetype"; MessagePack has the same structure as JSON,
+#Arrow IPC (a stream with one record batch) is only used for lists of rows, other results are sent as JSON
+def encode(data, mimetype=JSON):
+    if mimetype==MSGPACK:
+        return msgpack.packb(data), MSGPACK
+    if mimetype==ARROW and isinstance(data, list):
+        #rows don't all have the same keys (e.g. "artists" or "artist1".."artist3"), so the schema has a column
+        #for every key of any row (in order of appearance), null where a row doesn't have it
+        columns = list(dict.fromkeys(key for row in data for key in row))
+        arrays = [pyarrow.array([row.get(column) for row in data]) for column in columns]
+        schema = pyarrow.schema([(column, array.type) for column, array in zip(columns, arrays)])
+        table = pyarrow.Table.from_arrays(arrays, schema=schema)
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes(), ARROW
+    return encode_json(data), JSON
@@ -0,0 +1,190 @@
+import json
+from query_compiler import page_token
+from sketches import HyperLogLog, SpaceSaving
+
+#formatting of STATS results, shared by STATS.py (Flask) and stats_asgi.py
+
+#a request is identified by its query shape and parameters (already normalized by the compiler)
+def cache_key(shape, params):
+    return (shape,) + tuple((key, tuple(value) if isinstance(value, list) else value) for key, value in sorted(params.items()))
+
+#end of the date range a cached response depends on (see ResultCache.put); sessions are selected by their start,
+#but a session that started before the end keeps growing with later plays, so they depend on all plays
+def cache_end(endpoint, req):
+    return None if endpoint=="sessions" else req["end"]
+
+#quality of "mimetype" in an Accept header: the q of the most specific media range that matches it (0 if none does)
+def accept_quality(accept, mimetype):
+    specificity, quality = -1, 0.0
+    for part in accept.split(','):
+        media_range, *parameters = [value.strip() for value in part.split(';')]
+        media_range = media_range.lower()
+        if media_range in ['*/*', '*']:
+            rank = 0
+        elif media_range==mimetype.split('/')[0] + "/*":
+            rank = 1
+        elif media_range==mimetype:
+            rank = 2
+        else:
+            continue
+        q = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition('=')
+            if name.strip().lower()=="q":
+                try:
+                    q = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    q = 0.0
+        if rank>specificity:
+            specificity, quality = rank, q
+    return quality
+
+#the first of "offered" with the highest quality in the Accept header (the first one without a header),
+#None if none of them is acceptable; as werkzeug's best_match, so both servers negotiate the same way
+def best_match(accept, offered):
+    if not accept.strip():
+        return offered[0]
+    best, best_quality = None, 0.0
+    for mimetype in offered:
+        quality = accept_quality(accept, mimetype)
+        if quality>best_quality:
+            best, best_quality = mimetype, quality
+    return best
+
+#NDJSON is sent with format=ndjson or when the client prefers it to JSON
+def wants_ndjson(args, accept):
+    if args.get('format')=="ndjson":
+        return True
+    return best_match(accept, ['application/json', 'application/x-ndjson'])=='application/x-ndjson'
+
+#format ms to largest possible time unit
+def format_time(ms):
+    if ms is None:
+        return "0 s"
+    #same as splitting a timedelta into days, hours, minutes and seconds, without creating one
+    hours, remainder = divmod(int(ms // 1000), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    result = ""
+    if hours:
+        result = str(hours) + "h " + str(minutes) + "m " + str(seconds) + "s"
+    elif minutes:
+        result = str(minutes)+ "m " + str(seconds) + "s"
+    elif seconds:
+        result = str(seconds) + "s"
+    else:
+        result = "0 s"
+    
+    return result
+
+def format_result(results):
+    for record in results: #if records contain artists, rewrite them as a list
+        if record.get('artist1'): 
+            artists = [record['artist1']]
+            record.pop('artist1')
+            for i in range (2,4):
+                if record[f"artist{i}"] is not None:
+                    artists.append(record[f"artist{i}"])
+                record.pop(f"artist{i}")
+            record['artists'] = ", ".join(artists)
+            artists.clear()
+        else:
+            break
+    return results
+
+#format a row of a query shape for the response
+def format_row(endpoint, req, row):
+    row = format_result([row])[0]
+    if 'ms' in row:
+        if endpoint=="total":
+            if req["artists"]:
+                row['artist']=req["artists"][0]
+            row['total streaming time'] = format_time(row['ms'])
+        else:
+            row['totalDuration'] = format_time(row['ms'])
+        row.pop('ms')
+    return row
+
+#response body and the token of the next page (if the page is full) from the rows of a query shape
+def build_result(endpoint, req, shape, params, rows):
+    if endpoint=="summary":
+        return build_summary(endpoint, req, rows), None
+    if endpoint=="timeline":
+        return build_timeline(rows), None
+    if endpoint=="sessions":
+        return build_sessions(rows), None
+    if shape.endswith(".approx"):
+        return build_approx(endpoint, req, rows), None
+    next_page = None
+    if rows and params.get('limit') and len(rows)==params['limit']:
+        next_page = page_token(shape, rows[-1])
+    result = [format_row(endpoint, req, row) for row in rows]
+    if not result:
+        result = {"message":"No data found for the selected parameters."}
+    return result, next_page
+
+#rows with streams and duration, and the total time of the selection
+def build_summary(endpoint, req, rows):
+    if not rows:
+        return {"message":"No data found for the selected parameters."}
+    total_ms = rows[0]['total_ms']
+    results = []
+    for row in rows:
+        row.pop('total_ms')
+        results.append(format_row(endpoint, req, row))
+    return {"results": results, "total streaming time": format_time(total_ms)}
+
+#buckets (local time, ISO format) with streams, duration in ms and formatted duration
+def build_timeline(rows):
+    if not rows:
+        return {"message":"No data found for the selected parameters."}
+    for row in rows:
+        row['bucket'] = row['bucket'].isoformat()
+        row['totalDuration'] = format_time(row['ms'])
+    return rows
+
+#top artists/tracks merged from the daily sketches: every count is an upper bound, at most "error" above the
+#true count; the number of distinct artists/tracks has the relative standard error "distinct error"
+def build_approx(endpoint, req, rows):
+    measure = "streams" if endpoint=="streams" else "ms"
+    if not rows:
+        return {"message":"No data found for the selected parameters."}
+    capacity = max(row[measure]["capacity"] for row in rows)
+    summary = SpaceSaving.merged(capacity, [SpaceSaving.from_json(row[measure]) for row in rows])
+    distinct = HyperLogLog()
+    for row in rows:
+        distinct.merge_bytes(row['distinct_items'])
+    results = []
+    for item, count, error in summary.top(req["limit"]):
+        if req["type"]=="artists":
+            row = {measure: count, "artist": item}
+        else:
+            row = {measure: count, "artist1": item[0], "artist2": item[1], "artist3": item[2], "track_name": item[3]}
+        row = format_row(endpoint, req, row)
+        if measure=="streams":
+            row['streamsError'] = error
+        else:
+            row['durationError'] = format_time(error)
+        results.append(row)
+    if not results:
+        return {"message":"No data found for the selected parameters."}
+    return {
+        "results": results,
+        f"distinct {req['type']}": distinct.count(),
+        "distinct error": f"{distinct.relative_error():.1%}"
+    }
+
+#number of sessions, their average length and tracks, and the time streamed in them
+def build_sessions(rows):
+    row = rows[0] if rows else None
+    if not row or not row['sessions']:
+        return {"message":"No data found for the selected parameters."}
+    return {
+        "sessions": row['sessions'],
+        "average session length": format_time(row['length_ms']),
+        "average tracks per session": round(row['tracks'], 1),
+        "total streaming time": format_time(row['ms'])
+    }
+
+#JSON as produced by Flask's jsonify (sorted keys, compact, ASCII only, trailing newline)
+def dumps(data):
+    return json.dumps(data, ensure_ascii=True, sort_keys=True, separators=(",", ":")) + "\n"
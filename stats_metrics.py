@@ -0,0 +1,112 @@
+import collections
+import threading
+import time
+from datetime import datetime, timezone
+
+#request instrumentation of STATS, shared by STATS.py (Flask) and stats_asgi.py:
+#duration of every phase of a request as a histogram per endpoint and query shape (Prometheus text format, /metrics),
+#the phases of the current request in the "Server-Timing" header, and the plans of slow queries (/debug/slow-queries)
+
+#upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+#phases of one request; the time since the previous lap is added to the named phase:
+#parse (parameters, dates, query shape), cache (result cache lookup), pool (connection checkout),
+#execute (query), fetch (rows), format (rows to the response body), serialize (JSON);
+#error is the time until an unexpected exception of a failed request
+class PhaseTimer:
+    def __init__(self):
+        self.phases = {}
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+        return now
+
+    def total(self):
+        return sum(self.phases.values())
+
+    #e.g. "parse;dur=0.12, execute;dur=35.40, total;dur=36.02" (milliseconds)
+    def server_timing(self):
+        phases = list(self.phases.items()) + [("total", self.total())]
+        return ", ".join(f"{phase};dur={seconds*1000:.2f}" for phase, seconds in phases)
+
+class Metrics:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        #(endpoint, shape, status, phase): [count per bucket..., sum, count]
+        self.histograms = {}
+
+    #"status" is the HTTP status of the response (500 for an unexpected exception)
+    def observe(self, endpoint, shape, timer, status=200):
+        with self.lock:
+            for phase, seconds in list(timer.phases.items()) + [("total", timer.total())]:
+                key = (endpoint, shape, str(status), phase)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = [0]*(len(self.buckets)+2)
+                for i, bound in enumerate(self.buckets):
+                    if seconds<=bound:
+                        histogram[i] += 1
+                        break
+                histogram[-2] += seconds
+                histogram[-1] += 1
+
+    #all histograms in Prometheus text format
+    def render(self):
+        lines = ["# HELP stats_request_phase_seconds Duration of the phases of STATS requests.",
+                 "# TYPE stats_request_phase_seconds histogram"]
+        with self.lock:
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        for (endpoint, shape, status, phase), histogram in sorted(histograms.items()):
+            labels = f'endpoint="{endpoint}",shape="{shape}",status="{status}",phase="{phase}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram):
+                cumulative += count
+                lines.append(f'stats_request_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'stats_request_phase_seconds_bucket{{{labels},le="+Inf"}} {histogram[-1]}')
+            lines.append(f'stats_request_phase_seconds_sum{{{labels}}} {histogram[-2]:.6f}')
+            lines.append(f'stats_request_phase_seconds_count{{{labels}}} {histogram[-1]}')
+        return "\n".join(lines) + "\n"
+
+#SQL, parameters and plan of the last "size" queries that ran longer than "threshold_ms" (disabled if None);
+#the plan comes from running the query again with EXPLAIN, at most once at a time per query shape
+class SlowQueryLog:
+    explain = "EXPLAIN (ANALYZE, BUFFERS) "
+
+    def __init__(self, threshold_ms=None, size=20):
+        self.threshold_ms = threshold_ms
+        self.entries = collections.deque(maxlen=size)
+        self.capturing = set()
+        self.lock = threading.Lock()
+
+    #true if the query should be explained; the caller then runs the EXPLAIN and calls record()
+    def begin(self, shape, seconds):
+        if self.threshold_ms is None or seconds*1000<self.threshold_ms:
+            return False
+        with self.lock:
+            if shape in self.capturing:
+                return False
+            self.capturing.add(shape)
+            return True
+
+    def record(self, endpoint, shape, seconds, sql, params, plan):
+        with self.lock:
+            self.capturing.discard(shape)
+            self.entries.appendleft({
+                "time": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                "endpoint": endpoint,
+                "shape": shape,
+                "ms": round(seconds*1000, 1),
+                "sql": sql,
+                "params": {key: None if value is None else str(value) for key, value in params.items()},
+                "plan": plan
+            })
+
+    #newest first
+    def list(self):
+        with self.lock:
+            return {"threshold_ms": self.threshold_ms, "queries": list(self.entries)}
@@ -0,0 +1,43 @@
+import pytest
+from query_compiler import SHAPES, QueryCompiler, RequestError
+from stats_format import cache_key
+
+#request parameters and query shapes of the STATS account dimension (no database)
+
+#query parameters as passed by Flask/Starlette (one value per parameter, except "artist")
+class Args(dict):
+    def getlist(self, key):
+        value = self.get(key)
+        return [] if value is None else [value]
+
+compiler = QueryCompiler("Europe/Berlin")
+
+def bind(endpoint, args):
+    return compiler.bind(endpoint, compiler.parse(endpoint, Args(args)))
+
+def test_every_shape_has_account():
+    for shape, query in SHAPES.items():
+        assert "%(account)s" in query, shape
+
+def test_all_accounts_by_default():
+    requests = [("streams", {"type": "tracks"}), ("duration", {"type": "artists", "approx": "true"}), ("summary", {"artist": "A"}),
+                ("timeline", {}), ("sessions", {}), ("total", {}), ("total", {"artist": "A"})]
+    for endpoint, args in requests:
+        shape, params = bind(endpoint, args)
+        assert params["account"] is None, shape
+
+def test_account_in_params_and_cache_key():
+    shape, params = bind("streams", {"type": "tracks", "account": "alice"})
+    assert params["account"]=="alice"
+    other_shape, other = bind("streams", {"type": "tracks", "account": "bob"})
+    assert shape==other_shape
+    assert cache_key(shape, params)!=cache_key(other_shape, other)
+    assert cache_key(shape, params)!=cache_key(*bind("streams", {"type": "tracks"}))
+
+def test_empty_account_is_all_accounts():
+    shape, params = bind("total", {"account": ""})
+    assert params["account"] is None
+
+def test_account_is_not_a_selection():
+    with pytest.raises(RequestError):
+        compiler.parse("streams", Args({"account": "alice", "limit": "5"}))
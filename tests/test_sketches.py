@@ -0,0 +1,109 @@
+import json
+import random
+from datetime import date
+from sketches import HyperLogLog, SpaceSaving, build_sketches
+
+#error bounds reported by approx=true responses, checked against exact counts (no database)
+
+#daily counts with a long tail, as in the rollups: a few items with large counts and many with small ones
+def daily_counts(rng, days, items):
+    return [{f"item {i}": int(rng.paretovariate(1.2)) for i in rng.sample(range(items), items//4)} for _ in range(days)]
+
+def true_totals(days):
+    totals = {}
+    for counts in days:
+        for item, count in counts.items():
+            totals[item] = totals.get(item, 0) + count
+    return totals
+
+def test_from_counts_floor():
+    rng = random.Random(1)
+    for counts in daily_counts(rng, 20, 500):
+        summary = SpaceSaving.from_counts(10, counts)
+        assert len(summary.counters)==10
+        for item, count in counts.items():
+            if item in summary.counters:
+                assert summary.counters[item]==[count, 0]
+            else:
+                assert count<=summary.floor
+
+def test_from_counts_below_capacity():
+    summary = SpaceSaving.from_counts(10, {"a": 3, "b": 1})
+    assert summary.floor==0
+    assert summary.top()==[("a", 3, 0), ("b", 1, 0)]
+
+def test_merged_bounds():
+    rng = random.Random(2)
+    for capacity in [5, 20, 50]:
+        days = daily_counts(rng, 30, 400)
+        totals = true_totals(days)
+        merged = SpaceSaving.merged(capacity, [SpaceSaving.from_counts(capacity, counts) for counts in days])
+        assert len(merged.counters)<=capacity
+        for item, count, error in merged.top():
+            assert count>=totals[item] #upper bound
+            assert count-error<=totals[item] #lower bound
+        #items that are not kept have at most "floor"
+        for item, total in totals.items():
+            if item not in merged.counters:
+                assert total<=merged.floor
+
+def test_merged_exact_without_truncation():
+    days = [{"a": 5, "b": 2}, {"a": 1, "c": 4}]
+    merged = SpaceSaving.merged(10, [SpaceSaving.from_counts(10, counts) for counts in days])
+    assert merged.floor==0
+    assert merged.top()==[("a", 6, 0), ("c", 4, 0), ("b", 2, 0)]
+
+def test_merged_of_merged_bounds():
+    rng = random.Random(3)
+    days = daily_counts(rng, 60, 300)
+    totals = true_totals(days)
+    summaries = [SpaceSaving.from_counts(15, counts) for counts in days]
+    months = [SpaceSaving.merged(15, summaries[i:i+30]) for i in range(0, 60, 30)]
+    merged = SpaceSaving.merged(15, months)
+    for item, count, error in merged.top():
+        assert count-error<=totals[item]<=count
+    for item, total in totals.items():
+        if item not in merged.counters:
+            assert total<=merged.floor
+
+def test_space_saving_json():
+    summary = SpaceSaving.from_counts(2, {("Artist", None, None, "Track"): 3, ("Other", "Feat", None, "Song"): 2, ("X", None, None, "Y"): 1})
+    restored = SpaceSaving.from_json(summary.to_json())
+    assert restored.counters==summary.counters
+    assert (restored.capacity, restored.floor)==(summary.capacity, summary.floor)
+
+def test_hyperloglog_estimate():
+    for size in [10, 100, 1000, 10000, 100000]:
+        sketch = HyperLogLog()
+        for i in range(size):
+            sketch.add(f"track {i}")
+        assert abs(sketch.count()-size)<=max(3*sketch.relative_error()*size, 2)
+
+def test_hyperloglog_duplicates():
+    sketch = HyperLogLog()
+    for _ in range(5):
+        for i in range(1000):
+            sketch.add(f"artist {i}")
+    assert abs(sketch.count()-1000)<=3*sketch.relative_error()*1000
+
+def test_hyperloglog_merge():
+    #overlapping days: the merged sketch counts the union
+    union = HyperLogLog()
+    for day in range(30):
+        sketch = HyperLogLog()
+        for i in range(day*100, day*100+500):
+            sketch.add(f"track {i}")
+        union.merge_bytes(sketch.to_bytes())
+    size = 29*100+500
+    assert abs(union.count()-size)<=3*union.relative_error()*size
+
+def test_build_sketches_per_account():
+    day = date(2024, 1, 1)
+    pairs = [(day, "alice"), (day, "bob"), (day, "carol")]
+    rows = [(day, "alice", "Artist", 3, 1000), (day, "bob", "Artist", 1, 500), (day, "bob", "Other", 2, 800)]
+    sketches = {(row[0], row[1]): row for row in build_sketches("artists", pairs, rows, 10)}
+    assert SpaceSaving.from_json(json.loads(sketches[(day, "alice")][3])).top()==[("Artist", 3, 0)]
+    assert SpaceSaving.from_json(json.loads(sketches[(day, "bob")][3])).top()==[("Other", 2, 0), ("Artist", 1, 0)]
+    #an account without rows gets an empty sketch, so its removed plays are cleared
+    assert SpaceSaving.from_json(json.loads(sketches[(day, "carol")][3])).top()==[]
+    assert sketches[(day, "carol")][5]==b""